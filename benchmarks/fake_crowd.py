@@ -0,0 +1,457 @@
+#
+# fake_crowd.py
+#
+# Local stand-in for the Crowd REST endpoints used by crowd_api, for benchmarking
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+TERM = re.compile(r'\s*([\w-]+)\s*=\s*"?([^"]*?)"?\s*$')
+
+
+def parse_terms(restriction):
+    """Split the `field = "value"` / `prefix*` / OR subset of CQL used by the benchmarks into (field, value) terms."""
+    terms = []
+    for term in re.split(r'\s+or\s+', restriction.strip().strip('()'), flags=re.I):
+        m = TERM.match(term.strip('() '))
+        if m is not None:
+            terms.append((m.group(1), m.group(2)))
+    return terms
+
+
+def matches(terms, entity):
+    for field, value in terms:
+        actual = str(entity.get(field, ''))
+        if value.endswith('*') and actual.startswith(value[:-1]):
+            return True
+        if actual == value:
+            return True
+    return False
+
+
+class Directory:
+    """Deterministic synthetic directory: users, a tree of groups and random direct memberships."""
+
+    def __init__(self, users=10000, groups=200, groups_per_user=3, fanout=5, seed=1):
+        rnd = random.Random(seed)
+
+        self.users = {}
+        for i in range(users):
+            name = "user{:06d}".format(i)
+            self.users[name] = {"name": name, "active": True, "first-name": "User", "last-name": str(i),
+                                "display-name": "User {}".format(i), "email": "{}@example.net".format(name),
+                                "attributes": {"attributes": [{"name": "department", "values": ["d{}".format(i % 10)]}]}}
+
+        self.groups = {}
+        self.children = {}
+        self.parents = {}
+        self.members = {}
+        names = ["group{:04d}".format(i) for i in range(groups)]
+        for i, name in enumerate(names):
+            self._add_group(name)
+            if i > 0:
+                parent = names[(i - 1) // fanout]
+                self.children[parent].add(name)
+                self.parents[name].add(parent)
+
+        self.user_groups = {name: set() for name in self.users}
+        for name in self.users:
+            for groupname in rnd.sample(names, min(groups_per_user, len(names))):
+                self.members[groupname].add(name)
+                self.user_groups[name].add(groupname)
+
+        # SSO sessions, token -> username
+        self.sessions = {}
+
+        # change feed served by /event, tokens are offsets into this list
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, kind, operation, **payload):
+        self.events.append(dict(payload, type=kind, operation=operation))
+
+    def _add_group(self, name, description=""):
+        self.groups[name] = {"name": name, "type": "GROUP", "description": description, "active": True}
+        self.children[name] = set()
+        self.parents[name] = set()
+        self.members[name] = set()
+
+    def _closure(self, name, edges):
+        seen = set()
+        stack = list(edges.get(name, ()))
+        while stack:
+            node = stack.pop()
+            if node not in seen:
+                seen.add(node)
+                stack.extend(edges.get(node, ()))
+        return seen
+
+    def nested_user_groups(self, username):
+        groups = set(self.user_groups.get(username, ()))
+        for groupname in list(groups):
+            groups |= self._closure(groupname, self.parents)
+        return groups
+
+    def nested_group_users(self, groupname):
+        users = set(self.members.get(groupname, ()))
+        for child in self._closure(groupname, self.children):
+            users |= self.members[child]
+        return users
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if len(payload) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload, 5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _parse(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.server.counter.get_lock():
+            self.server.counter.value += 1
+
+        url = urlsplit(self.path)
+        path = url.path[len(self.server.prefix):]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        return path, params, body
+
+    @staticmethod
+    def _page(items, params):
+        start = int(params.get("start-index", 0))
+        size = int(params.get("max-results", 1000))
+        if not isinstance(items, list):
+            items = sorted(items)
+        return items[start:start + size]
+
+    def _names(self, key, items, params):
+        self._reply(200, {"expand": key[:-1], key: [{"name": n} for n in self._page(items, params)]})
+
+    def do_GET(self):
+        path, params, _ = self._parse()
+        d = self.server.directory
+
+        with d.lock:
+            if path == "/config/cookie":
+                return self._reply(200, {"domain": None, "secure": False, "name": "crowd.token_key"})
+
+            if path == "/event":
+                return self._reply(200, {"newEventToken": str(len(d.events))})
+
+            if path.startswith("/event/"):
+                offset = int(path[len("/event/"):])
+                if offset > len(d.events):
+                    return self._reply(410, {"reason": "EVENT_TOKEN_EXPIRED"})
+                return self._reply(200, {"newEventToken": str(len(d.events)), "events": d.events[offset:]})
+
+            if path == "/user":
+                user = d.users.get(params.get("username"))
+                if user is None:
+                    return self._reply(404, {"reason": "USER_NOT_FOUND"})
+                if "attributes" not in params.get("expand", ""):
+                    user = {k: v for k, v in user.items() if k != "attributes"}
+                return self._reply(200, user)
+
+            if path == "/user/attribute":
+                user = d.users.get(params.get("username"))
+                if user is None:
+                    return self._reply(404, {"reason": "USER_NOT_FOUND"})
+                return self._reply(200, user["attributes"])
+
+            if path in ("/user/group/direct", "/user/group/nested"):
+                if params.get("username") not in d.users:
+                    return self._reply(404, {"reason": "USER_NOT_FOUND"})
+                groups = d.user_groups[params["username"]] if path.endswith("direct") else \
+                    d.nested_user_groups(params["username"])
+                if "groupname" in params:
+                    if params["groupname"] in groups:
+                        return self._reply(200, {"name": params["groupname"]})
+                    return self._reply(404, {"reason": "MEMBERSHIP_NOT_FOUND"})
+                return self._names("groups", groups, params)
+
+            if path == "/group":
+                group = d.groups.get(params.get("groupname"))
+                if group is None:
+                    return self._reply(404, {"reason": "GROUP_NOT_FOUND"})
+                return self._reply(200, group)
+
+            if path == "/group/attribute":
+                if params.get("groupname") not in d.groups:
+                    return self._reply(404, {"reason": "GROUP_NOT_FOUND"})
+                return self._reply(200, {"attributes": []})
+
+            if path.startswith("/group/"):
+                groupname = params.get("groupname")
+                if groupname not in d.groups:
+                    return self._reply(404, {"reason": "GROUP_NOT_FOUND"})
+
+                if path in ("/group/user/direct", "/group/user/nested"):
+                    users = d.members[groupname] if path.endswith("direct") else d.nested_group_users(groupname)
+                    if "username" in params:
+                        if params["username"] in users:
+                            return self._reply(200, {"name": params["username"]})
+                        return self._reply(404, {"reason": "MEMBERSHIP_NOT_FOUND"})
+                    return self._names("users", users, params)
+
+                relations = {
+                    "/group/parent-group/direct": lambda: d.parents[groupname],
+                    "/group/parent-group/nested": lambda: d._closure(groupname, d.parents),
+                    "/group/child-group/direct": lambda: d.children[groupname],
+                    "/group/child-group/nested": lambda: d._closure(groupname, d.children),
+                }
+                if path in relations:
+                    return self._names("groups", relations[path](), params)
+
+            if path == "/search":
+                entities = d.users if params.get("entity-type") == "user" else d.groups
+                key = "users" if params.get("entity-type") == "user" else "groups"
+                terms = parse_terms(params["restriction"]) if "restriction" in params else None
+                if terms is None:
+                    names = list(entities)
+                elif all(f == "name" and not v.endswith("*") for f, v in terms):
+                    # exact name lookups, served from the index like a real directory would
+                    names = [v for _, v in terms if v in entities]
+                else:
+                    names = [n for n, e in entities.items() if matches(terms, e)]
+                if "user" in params.get("expand", "") or "group" in params.get("expand", ""):
+                    return self._reply(200, {key: [entities[n] for n in self._page(names, params)]})
+                return self._names(key, names, params)
+
+        self._reply(404, {"reason": "NOT_FOUND"})
+
+    def do_POST(self):
+        path, params, body = self._parse()
+        d = self.server.directory
+
+        with d.lock:
+            if path == "/user":
+                if body["name"] in d.users:
+                    return self._reply(400, {"reason": "INVALID_USER"})
+                d.users[body["name"]] = dict(body, attributes={"attributes": []})
+                d.user_groups[body["name"]] = set()
+                d.record("USER", "CREATED", user={k: v for k, v in body.items() if k != "password"})
+                return self._reply(201)
+
+            if path == "/user/attribute":
+                user = d.users.get(params.get("username"))
+                if user is None:
+                    return self._reply(404, {"reason": "USER_NOT_FOUND"})
+                user["attributes"]["attributes"] = [a for a in user["attributes"]["attributes"]
+                                                    if a["name"] not in {b["name"] for b in body["attributes"]}]
+                user["attributes"]["attributes"] += body["attributes"]
+                return self._reply(204)
+
+            if path == "/user/group/direct":
+                username, groupname = params.get("username"), body["name"]
+                if username not in d.users or groupname not in d.groups:
+                    return self._reply(404, {"reason": "NOT_FOUND"})
+                if groupname in d.user_groups[username]:
+                    return self._reply(409, {"reason": "MEMBERSHIP_ALREADY_EXISTS"})
+                d.user_groups[username].add(groupname)
+                d.members[groupname].add(username)
+                d.record("USER_MEMBERSHIP", "CREATED", childUser={"name": username}, parentGroups=[{"name": groupname}])
+                return self._reply(201)
+
+            if path == "/authentication":
+                user = d.users.get(params.get("username"))
+                if user is None or body["value"] != user.get("password", {}).get("value", "secret"):
+                    return self._reply(400, {"reason": "INVALID_USER_AUTHENTICATION"})
+                return self._reply(200, {k: v for k, v in user.items() if k not in ("password", "attributes")})
+
+            if path == "/session":
+                user = d.users.get(body["username"])
+                if user is None or body["password"] != user.get("password", {}).get("value", "secret"):
+                    return self._reply(400, {"reason": "INVALID_USER_AUTHENTICATION"})
+                token = "token{:08d}".format(len(d.sessions))
+                d.sessions[token] = user["name"]
+                return self._reply(201, {"token": token, "user": {"name": user["name"]}})
+
+            if path.startswith("/session/"):
+                token = path[len("/session/"):]
+                if token not in d.sessions:
+                    return self._reply(404, {"reason": "INVALID_SSO_TOKEN"})
+                return self._reply(200, {"token": token, "user": {"name": d.sessions[token]}})
+
+            if path == "/group":
+                if body["name"] in d.groups:
+                    return self._reply(400, {"reason": "INVALID_GROUP"})
+                d._add_group(body["name"], body.get("description", ""))
+                d.record("GROUP", "CREATED", group=d.groups[body["name"]])
+                return self._reply(201)
+
+        self._reply(404, {"reason": "NOT_FOUND"})
+
+    def do_PUT(self):
+        path, params, body = self._parse()
+        d = self.server.directory
+
+        with d.lock:
+            if path == "/user":
+                user = d.users.get(params.get("username"))
+                if user is None:
+                    return self._reply(404, {"reason": "USER_NOT_FOUND"})
+                user.update({k: v for k, v in body.items() if k != "attributes"})
+                d.record("USER", "UPDATED", user={k: v for k, v in user.items() if k != "attributes"})
+                return self._reply(204)
+
+        self._reply(404, {"reason": "NOT_FOUND"})
+
+    def do_DELETE(self):
+        path, params, _ = self._parse()
+        d = self.server.directory
+
+        with d.lock:
+            if path.startswith("/session/"):
+                d.sessions.pop(path[len("/session/"):], None)
+                return self._reply(204)
+
+            if path == "/user/group/direct":
+                username, groupname = params.get("username"), params.get("groupname")
+                if groupname not in d.user_groups.get(username, ()):
+                    return self._reply(404, {"reason": "MEMBERSHIP_NOT_FOUND"})
+                d.user_groups[username].discard(groupname)
+                d.members[groupname].discard(username)
+                d.record("USER_MEMBERSHIP", "DELETED", childUser={"name": username}, parentGroups=[{"name": groupname}])
+                return self._reply(204)
+
+            if path == "/group":
+                groupname = params.get("groupname")
+                if groupname not in d.groups:
+                    return self._reply(404, {"reason": "GROUP_NOT_FOUND"})
+                for username in d.members.pop(groupname):
+                    d.user_groups[username].discard(groupname)
+                for child in d.children.pop(groupname):
+                    d.parents[child].discard(groupname)
+                for parent in d.parents.pop(groupname):
+                    d.children[parent].discard(groupname)
+                d.record("GROUP", "DELETED", group=d.groups.pop(groupname))
+                return self._reply(204)
+
+        self._reply(404, {"reason": "NOT_FOUND"})
+
+
+class FakeCrowd:
+    """Threaded HTTP server serving a synthetic Directory under /rest/usermanagement/1."""
+
+    prefix = "/rest/usermanagement/1"
+
+    def __init__(self, directory=None, latency=0.0, host="127.0.0.1", port=0):
+        self.directory = directory if directory is not None else Directory()
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.directory = self.directory
+        self.server.latency = latency
+        self.server.prefix = self.prefix
+        self.server.counter = multiprocessing.Value('L', 0)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}{}".format(host, port, self.prefix)
+
+    @property
+    def requests(self):
+        return self.server.counter.value
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeCrowdProcess:
+    """Run a FakeCrowd in a child process so the server does not compete with the client for the GIL."""
+
+    def __init__(self, latency=0.0, **directory_opts):
+        self.latency = latency
+        self.directory_opts = directory_opts
+        self.directory = Directory(**directory_opts)
+        self.counter = multiprocessing.Value('L', 0)
+        self.process = None
+        self.url = None
+
+    def _serve(self, queue):
+        server = FakeCrowd(self.directory, latency=self.latency)
+        server.server.counter = self.counter
+        queue.put(server.url)
+        server.server.serve_forever()
+
+    @property
+    def requests(self):
+        return self.counter.value
+
+    def start(self):
+        queue = multiprocessing.get_context("fork").Queue()
+        self.process = multiprocessing.get_context("fork").Process(target=self._serve, args=(queue,), daemon=True)
+        self.process.start()
+        self.url = queue.get(timeout=30)
+        return self.url
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Crowd REST server')
+    parser.add_argument("--host", default="127.0.0.1", help="Listen address (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8095, help="Listen port (default: %(default)s)")
+    parser.add_argument("--users", type=int, default=10000, help="Users in the directory (default: %(default)s)")
+    parser.add_argument("--groups", type=int, default=200, help="Groups in the directory (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency per request in ms (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: %(default)s)")
+    opts = parser.parse_args()
+
+    server = FakeCrowd(Directory(users=opts.users, groups=opts.groups, seed=opts.seed),
+                       latency=opts.latency / 1000.0, host=opts.host, port=opts.port)
+    print("Serving fake Crowd on " + server.url)
+    server.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# run.py
+#
+# Reproducible crowd_api benchmarks against the local fake Crowd server
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from crowd_api import CrowdAPI, GroupGraph, MembershipIndex  # noqa: E402
+from crowd_api.executor import run_concurrently  # noqa: E402
+from crowd_api.provision import provision_user  # noqa: E402
+from fake_crowd import FakeCrowdProcess  # noqa: E402
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))]
+
+
+def measure(name, fn, items, concurrency=1, memory=True):
+    """Run fn over items (optionally from a thread pool) and collect per-call latencies."""
+    items = list(items)
+    latencies = []
+
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - start)
+
+    if memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        for item in items:
+            timed(item)
+    else:
+        for _ in run_concurrently(timed, items, concurrency):
+            pass
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {"scenario": name, "ops": len(items), "seconds": round(elapsed, 4),
+            "ops_per_sec": round(len(items) / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "peak_mem_kb": round(peak / 1024, 1) if peak is not None else None}
+
+
+def scenarios(crowd, directory, opts):
+    rnd = random.Random(opts.seed)
+    usernames = sorted(directory.users)
+    lookups = [rnd.choice(usernames) for _ in range(opts.lookups)]
+
+    yield "single_lookup", lambda u: crowd.get_user(username=u), lookups, 1
+    yield "single_lookup_threads", lambda u: crowd.get_user(username=u), lookups, opts.concurrency
+    yield "batched_lookup", lambda batch: crowd.get_users(batch, concurrency=opts.concurrency), \
+        [lookups[i:i + 100] for i in range(0, len(lookups), 100)], 1
+
+    yield "paged_export_sequential", lambda _: list(crowd.iter_all_users(page_size=opts.page_size)), range(opts.exports), 1
+    yield "paged_export_parallel", \
+        lambda _: crowd.export_all_users(page_size=opts.page_size, workers=opts.concurrency), range(opts.exports), 1
+
+    groupnames = sorted(directory.groups)
+    new_users = [{"name": "bench{:06d}".format(i), "first-name": "Bench", "last-name": str(i),
+                  "display-name": "Bench {}".format(i), "email": "bench{}@example.net".format(i),
+                  "password": {"value": "secret"}, "groups": rnd.sample(groupnames, 2)} for i in range(opts.provision)]
+    yield "bulk_provision", lambda u: provision_user(crowd, u), new_users, opts.concurrency
+
+    tokens = [crowd.create_session(username=u, password="secret")['token'] for u in lookups[:20]]
+    validations = [rnd.choice(tokens) for _ in range(opts.lookups)]
+    cached = CrowdAPI(api_url=crowd.api_url, app_name="bench", app_password="bench", auth_cache_ttl=60)
+    yield "session_validation", lambda t: crowd.validate_session(token=t), validations, 1
+    yield "session_validation_cached", lambda t: cached.validate_session(token=t), validations, 1
+
+    checks = [(u, rnd.choice(groupnames)) for u in lookups]
+    indexed = CrowdAPI(api_url=crowd.api_url, app_name="bench", app_password="bench")
+    indexed.membership_index = MembershipIndex(indexed, page_size=opts.page_size)
+    yield "membership_check_remote", \
+        lambda c: crowd.is_user_in_group(username=c[0], groupname=c[1], nested=True), checks, 1
+    yield "membership_check_index", \
+        lambda c: indexed.is_user_in_group(username=c[0], groupname=c[1], nested=True), checks, 1
+
+    yield "nested_user_groups_remote", lambda u: crowd.get_nested_user_groups(username=u), lookups, 1
+
+    graph = {}
+
+    def local(u):
+        if "graph" not in graph:
+            graph["graph"] = GroupGraph(crowd, page_size=opts.page_size)
+        graph["graph"].nested_user_groups(u)
+
+    yield "nested_user_groups_graph", local, lookups, 1
+
+
+def parse_opts():
+    parser = argparse.ArgumentParser(description='crowd_api benchmarks')
+    parser.add_argument("--users", type=int, default=10000, help="Users in the fake directory (default: %(default)s)")
+    parser.add_argument("--groups", type=int, default=200, help="Groups in the fake directory (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=1.0, help="Server-side latency per request in ms (default: %(default)s)")
+    parser.add_argument("--lookups", type=int, default=500, help="Lookups per lookup scenario (default: %(default)s)")
+    parser.add_argument("--exports", type=int, default=3, help="Full exports per export scenario (default: %(default)s)")
+    parser.add_argument("--provision", type=int, default=200, help="Users created by the provisioning scenario (default: %(default)s)")
+    parser.add_argument("--page-size", type=int, default=1000, dest="page_size", help="Page size (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Worker threads for concurrent scenarios (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: %(default)s)")
+    parser.add_argument("--scenario", action="append", dest="scenarios", help="Only run the given scenario (repeatable)")
+    parser.add_argument("--no-memory", action="store_false", dest="memory", help="Skip tracemalloc peak memory tracking")
+    parser.add_argument("--json", dest="json_file", help="Also write the results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_opts()
+
+    results = []
+
+    with FakeCrowdProcess(latency=opts.latency / 1000.0, users=opts.users, groups=opts.groups, seed=opts.seed) as server:
+        directory = server.directory
+        with CrowdAPI(api_url=server.url, app_name="bench", app_password="bench",
+                      pool_maxsize=max(10, opts.concurrency)) as crowd:
+            for name, fn, items, concurrency in scenarios(crowd, directory, opts):
+                if opts.scenarios and name not in opts.scenarios:
+                    continue
+                before = server.requests
+                result = measure(name, fn, items, concurrency, opts.memory)
+                result["http_requests"] = server.requests - before
+                results.append(result)
+
+    columns = ["scenario", "ops", "seconds", "ops_per_sec", "p50_ms", "p99_ms", "peak_mem_kb", "http_requests"]
+    print("  ".join("{:>26}".format(c) if i == 0 else "{:>12}".format(c) for i, c in enumerate(columns)))
+    for result in results:
+        print("  ".join("{:>26}".format(str(result[c])) if i == 0 else "{:>12}".format(str(result[c]))
+                        for i, c in enumerate(columns)))
+
+    if opts.json_file:
+        with open(opts.json_file, 'w') as fd:
+            json.dump({"options": vars(opts), "results": results}, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,51 @@
 #
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
 import random
 import string
+import sys
 from urllib.parse import urlencode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .aio import AsyncCrowdAPI
+from .auth import AuthCache
+from .cache import TTLCache
+from .exceptions import CrowdAPIError, CircuitOpenError
+from .graph import GroupGraph
+from .instrumentation import Instrumentation, Exporter, PrometheusExporter, RequestEvent
+from .models import Attribute, User, Group
+from .nodes import NodePool
+from . import membership, provision
+from .membership import BloomFilter, MembershipIndex
+from .executor import run_concurrently
+from .reconcile import MembershipReconciler, MembershipPlan, load_desired
+from .scheduler import RequestScheduler
+from .serializers import JSONSerializer, OrjsonSerializer, default_serializer
+from .singleflight import SingleFlight, normalize_query
+from .restriction import LocalSearch, LocalSearchIndex, UnsupportedRestriction, parse as parse_restriction
+from .store import SnapshotStore
+from .sync import DirectorySync, SyncEvent
+from .offline import OfflineCrowdAPI, export_snapshot
+
+# answer to a conditional update whose ETag no longer matches
+PRECONDITION_FAILED = 412
+
+# default time-to-live, in seconds, of each kind of cached lookup
+CACHE_TTL = {"user": 60, "user_groups": 60, "nested_user_groups": 60}
 
 
 class CrowdAPI:
     def __init__(self, **kwargs):
-        if 'api_url' not in kwargs:
+        if 'api_url' not in kwargs and 'api_urls' not in kwargs:
             raise ValueError("Crowd API URL must be given")
 
-        self.api_url = kwargs['api_url']
+        # several URLs, one per node of a cluster, are load balanced
+        urls = kwargs.get('api_urls') or kwargs['api_url']
+        if isinstance(urls, str):
+            urls = [urls]
+        self.api_url = urls[0]
 
         if 'app_name' not in kwargs:
             raise ValueError("Crowd API application name must be given")
@@ -36,39 +69,239 @@ class CrowdAPI:
         else:
             self.timeout = kwargs['timeout']
 
-    def api_get(self, query):
-        req = requests.get(self.api_url + query, headers={"Content-Type": "application/json",
-                                                          "Accept": "application/json"}, auth=self.auth, verify=self.verify_ssl, timeout=self.timeout)
-        return req
+        # one pooled session shared by every call, so connections are kept
+        # alive across requests instead of paying a TCP/TLS handshake each time
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.verify = self.verify_ssl
+        self.session.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+
+        # requests already asks for gzip/deflate responses; compression=False
+        # turns that off where CPU matters more than bytes, e.g. on a local link
+        if not kwargs.get('compression', True):
+            self.session.headers['Accept-Encoding'] = "identity"
+
+        adapter = HTTPAdapter(pool_connections=kwargs.get('pool_connections', 10),
+                              pool_maxsize=kwargs.get('pool_maxsize', 10),
+                              pool_block=kwargs.get('pool_block', False))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # the pool runs a probe thread, stopped by close() (or leaving a with
+        # block); the probe must not reference the client, or the thread
+        # would keep a client that is never closed alive forever
+        if len(urls) > 1:
+            probe_path = kwargs.get('probe_path', "/config/cookie")
+            session, timeout, verify = self.session, self.timeout, self.verify_ssl
+            self.nodes = NodePool(urls, strategy=kwargs.get('node_strategy', "least_outstanding"),
+                                  failure_threshold=kwargs.get('node_failure_threshold', 3),
+                                  eject_time=kwargs.get('node_eject_time', 30),
+                                  slow_threshold=kwargs.get('node_slow_threshold'),
+                                  probe=lambda url: session.get(
+                                      url + probe_path, timeout=timeout, verify=verify).status_code == 200,
+                                  probe_interval=kwargs.get('probe_interval', 10))
+        else:
+            self.nodes = None
 
-    def api_post(self, query, data):
-        req = requests.post(self.api_url + query, headers={"Content-Type": "application/json", "Accept": "application/json"},
-                            auth=self.auth, data=json.dumps(data), verify=self.verify_ssl, timeout=self.timeout)
-        return req
-    
-    def api_put(self, query, data):
-        req = requests.put(self.api_url + query, headers={"Content-Type": "application/json", "Accept": "application/json"},
-                            auth=self.auth, data=json.dumps(data), verify=self.verify_ssl, timeout=self.timeout)
-        return req
+        # opt-in read-through cache for user and membership lookups
+        self.cache = None
+        if kwargs.get('cache', False):
+            self.cache = TTLCache(maxsize=kwargs.get('cache_size', 10000))
+
+        self.cache_ttl = dict(CACHE_TTL, **kwargs.get('cache_ttl', {}))
+        self.negative_ttl = kwargs.get('negative_ttl', 10)
+
+        # retries, backoff, rate limiting and circuit breaking for every request
+        if 'scheduler' in kwargs:
+            self.scheduler = kwargs['scheduler']
+        else:
+            self.scheduler = RequestScheduler(max_retries=kwargs.get('max_retries', 3),
+                                              backoff_factor=kwargs.get('backoff_factor', 0.5),
+                                              max_backoff=kwargs.get('max_backoff', 30),
+                                              rate_limit=kwargs.get('rate_limit'),
+                                              rate_burst=kwargs.get('rate_burst'),
+                                              breaker_threshold=kwargs.get('breaker_threshold'),
+                                              breaker_timeout=kwargs.get('breaker_timeout', 30))
+
+        # opt-in request hooks and per-endpoint latency histograms
+        self.instrumentation = kwargs.get('instrumentation')
+        if self.instrumentation is True:
+            self.instrumentation = Instrumentation()
+
+        # share one response among concurrent identical GETs
+        self.singleflight = SingleFlight() if kwargs.get('coalesce', False) else None
+
+        # JSON backend for request bodies and responses, orjson when installed
+        self.serializer = kwargs.get('serializer') or default_serializer()
+
+        # intern the names yielded by the paged listings, so large snapshots
+        # holding the same names many times over share one string per name
+        self.intern_names = kwargs.get('intern_names', False)
+
+        # opt-in cache of successful authentications and validated sessions
+        if kwargs.get('auth_cache_ttl'):
+            self.auth_cache = AuthCache(ttl=kwargs['auth_cache_ttl'], maxsize=kwargs.get('auth_cache_size', 10000))
+        else:
+            self.auth_cache = None
+
+        # local member sets short-cutting is_user_in_group
+        self.membership_index = kwargs.get('membership_index')
+        if self.membership_index is True:
+            self.membership_index = membership.MembershipIndex(self)
+
+        # answer search_user/search_group from locally indexed entities,
+        # rebuilt every local_search seconds (True for the default of 300)
+        local_search = kwargs.get('local_search')
+        if local_search:
+            self.local_search = LocalSearch(self, ttl=300 if local_search is True else local_search)
+        else:
+            self.local_search = None
+
+    def close(self):
+        """Release the pooled connections."""
+        if self.nodes is not None:
+            self.nodes.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cached(self, key, fetch):
+        """Serve a lookup from the cache, calling fetch() and caching the result on a miss.
+
+        Cached results are shared between callers and must be treated as read-only.
+        """
+        if self.cache is None:
+            return fetch()
+
+        res = self.cache.get(key)
+        if res is not None:
+            return res
+
+        res = fetch()
+        if res['status']:
+            self.cache.set(key, res, self.cache_ttl[key[0]])
+        elif 'code' not in res:
+            # not found
+            self.cache.set(key, res, self.negative_ttl)
+
+        return res
+
+    def _invalidate(self, kind, name=None):
+        if self.cache is not None:
+            self.cache.invalidate(kind, name)
+
+    def _search_locally(self, entity_type, kwargs):
+        """Names matching the restriction from the local index, or None when the server has to answer."""
+        if self.local_search is None:
+            return None
+        try:
+            return self.local_search.search(entity_type, kwargs['restriction'],
+                                            start_index=kwargs.get('start_index', 0),
+                                            max_results=kwargs.get('max_results', 1000))
+        except (UnsupportedRestriction, CrowdAPIError):
+            return None
+
+    def cache_stats(self):
+        """Return the hit/miss/eviction counters of the cache, or None if caching is disabled."""
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def _request(self, method, query, data=None, headers=None, endpoint=None):
+        # passed on every call: a session-level verify loses to REQUESTS_CA_BUNDLE
+        kwargs = {"timeout": self.timeout, "verify": self.verify_ssl}
+        if data is not None:
+            kwargs['data'] = self.serializer.dumps(data)
+        if headers is not None:
+            kwargs['headers'] = headers
+
+        def send():
+            if self.nodes is not None:
+                return self.nodes.send(lambda url: self.session.request(method, url + query, **kwargs),
+                                       idempotent=method != "POST", write=method != "GET")
+            return self.session.request(method, self.api_url + query, **kwargs)
+
+        if self.instrumentation is None:
+            return self.scheduler.execute(send, idempotent=method != "POST")
+
+        # requests whose path holds a token are reported under their template
+        event = RequestEvent(method, endpoint or query)
+        self.instrumentation.before(event)
+        try:
+            req = self.scheduler.execute(send, idempotent=method != "POST", event=event)
+        except Exception as e:
+            event.error = e
+            raise
+        else:
+            event.status = req.status_code
+            event.bytes = len(req.content)
+        finally:
+            self.instrumentation.after(event)
 
-    def api_delete(self, query, data):
-        req = requests.delete(self.api_url + query, headers={"Content-Type": "application/json", "Accept": "application/json"},
-                              auth=self.auth, data=json.dumps(data), verify=self.verify_ssl, timeout=self.timeout)
         return req
 
+    def api_get(self, query, endpoint=None):
+        if self.singleflight is not None:
+            return self.singleflight.do(normalize_query(query), lambda: self._request("GET", query, endpoint=endpoint))
+        return self._request("GET", query, endpoint=endpoint)
+
+    def api_post(self, query, data, endpoint=None):
+        return self._request("POST", query, data, endpoint=endpoint)
+
+    def api_put(self, query, data, headers=None):
+        return self._request("PUT", query, data, headers)
+
+    def api_delete(self, query, data, endpoint=None):
+        return self._request("DELETE", query, data, endpoint=endpoint)
+
     def get_user(self, **kwargs):
+        """Fetch a user document, with its attributes unless `expand` is None.
+
+        Models of users fetched without attributes load them on first access.
+        """
         if "username" not in kwargs:
             raise ValueError("Must pass username")
 
+        expand = kwargs.get('expand', "attributes")
+        res = self._cached(("user", kwargs['username'], expand), lambda: self._get_user(**kwargs))
+        if kwargs.get('as_model') and res['status']:
+            return {"status": True, "user": User.from_json(res['user'], self._attribute_loader("user", res['user']))}
+        return res
+
+    def _get_user(self, **kwargs):
+        expand = kwargs.get('expand', "attributes")
         req = self.api_get(
-            "/user?username={}&expand=attributes".format(kwargs['username']))
+            "/user?username={}".format(kwargs['username']) + ("&expand={}".format(expand) if expand else ""))
         if req.status_code == 200:
-            return {"status": True, "user": req.json()}
+            res = {"status": True, "user": self.serializer.loads(req.content)}
+            if req.headers.get('ETag'):
+                res['etag'] = req.headers['ETag']
+            return res
         if req.status_code == 404:
             return {"status": False, "user": None}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
+    def _attribute_loader(self, entity_type, doc):
+        """Callable fetching the attributes of an entity document that came without them, or None."""
+        if doc.get('attributes') is not None:
+            return None
+
+        def load():
+            if entity_type == "user":
+                res = self.get_user_attributes(username=doc['name'])
+            else:
+                res = self.get_group_attributes(groupname=doc['name'])
+            if not res['status']:
+                raise CrowdAPIError(res['code'], res['reason'])
+            return self.serializer.loads(res['Attributes'])['attributes']
+
+        return load
+
     def get_user_attributes(self, **kwargs):
         if "username" not in kwargs:
             raise ValueError("Must pass username")
@@ -79,17 +312,28 @@ class CrowdAPI:
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
-    def get_user_groups(self, **kwargs):
-        groups = []
+    def get_group_attributes(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
 
+        req = self.api_get("/group/attribute?groupname={}".format(kwargs['groupname']))
+        if req.status_code == 200:
+            return {"status": True, "Attributes": req.content}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def get_user_groups(self, **kwargs):
         if "username" not in kwargs:
             raise ValueError("Must pass username")
 
+        key = ("user_groups", kwargs['username'], kwargs.get('max_results'), kwargs.get('start_index'))
+        return self._cached(key, lambda: self._get_user_groups(**kwargs))
+
+    def _get_user_groups(self, **kwargs):
         req = self.api_get("/user/group/direct?username={}&max-results={}&start-index={}".format(
             kwargs['username'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
 
             return {"status": True, "groups": groups}
         if req.status_code == 404:
@@ -99,11 +343,15 @@ class CrowdAPI:
 
     def get_nested_user_groups(self, **kwargs) -> dict:
         """Retrieve the group that the user is a nested member of."""
-        endpoint = "/user/group/nested"
-
         if "username" not in kwargs:
             raise ValueError("Must pass username")
 
+        key = ("nested_user_groups", kwargs['username'], kwargs.get('max_results'), kwargs.get('start_index'))
+        return self._cached(key, lambda: self._get_nested_user_groups(**kwargs))
+
+    def _get_nested_user_groups(self, **kwargs) -> dict:
+        endpoint = "/user/group/nested"
+
         params = {'username': kwargs['username']}
 
         if kwargs.get('max_results') is not None:
@@ -113,13 +361,10 @@ class CrowdAPI:
 
         query = f"{endpoint}?{urlencode(params)}"
 
-        req = self.crowd.api_get(query)
-
-        groups = []
+        req = self.api_get(query)
 
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
             return {"status": True, "groups": groups}
         if req.status_code == 404:
             return {"status": False, "groups": []}
@@ -127,16 +372,13 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def get_group_users(self, **kwargs):
-        users = []
-
         if "groupname" not in kwargs:
             raise ValueError("Must pass username")
 
         req = self.api_get("/group/user/direct?groupname={}&max-results={}&start-index={}".format(
             kwargs['groupname'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
         if req.status_code == 200:
-            for user in req.json()['users']:
-                users.append(user['name'])
+            users = self.serializer.listing_names(req.content, 'users')
 
             return {"status": True, "users": users}
         if req.status_code == 404:
@@ -145,16 +387,13 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def get_nested_group_users(self, **kwargs):
-        users = []
-
         if "groupname" not in kwargs:
             raise ValueError("Must pass groupname")
 
-        req = self.api_get(
-            "/group/user/nested?groupname={}".format(kwargs['groupname']))
+        req = self.api_get("/group/user/nested?groupname={}&max-results={}&start-index={}".format(
+            kwargs['groupname'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
         if req.status_code == 200:
-            for user in req.json()['users']:
-                users.append(user['name'])
+            users = self.serializer.listing_names(req.content, 'users')
 
             return {"status": True, "users": users}
         if req.status_code == 404:
@@ -163,16 +402,13 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def get_parent_groups(self, **kwargs):
-        pgroups = []
-
         if "groupname" not in kwargs:
             raise ValueError("Must pass groupname")
 
         req = self.api_get(
             "/group/parent-group/direct?groupname={}".format(kwargs['groupname']))
         if req.status_code == 200:
-            for pgroup in req.json()['groups']:
-                pgroups.append(pgroup['name'])
+            pgroups = self.serializer.listing_names(req.content, 'groups')
 
             return {"status": True, "pgroups": pgroups}
         if req.status_code == 404:
@@ -181,16 +417,13 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def get_parent_groupsv2(self, **kwargs):
-        groups = []
-
         if "groupname" not in kwargs:
             raise ValueError("Must pass groupname")
 
         req = self.api_get(
             "/group/parent-group/direct?groupname={}".format(kwargs['groupname']))
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
 
             return {"status": True, "groups": groups}
         if req.status_code == 404:
@@ -214,12 +447,10 @@ class CrowdAPI:
 
         query = f"{endpoint}?{urlencode(params)}"
 
-        req = self.crowd.api_get(query)
+        req = self.api_get(query)
 
-        groups = []
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
             return {"status": True, "groups": groups}
         if req.status_code == 404:
             return {"status": False, "groups": []}
@@ -242,13 +473,10 @@ class CrowdAPI:
 
         query = f"{endpoint}?{urlencode(params)}"
 
-        req = self.crowd.api_get(query)
-
-        groups = []
+        req = self.api_get(query)
 
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
             return {"status": True, "groups": groups}
         if req.status_code == 404:
             return {"status": False, "groups": []}
@@ -271,13 +499,10 @@ class CrowdAPI:
 
         query = f"{endpoint}?{urlencode(params)}"
 
-        req = self.crowd.api_get(query)
-
-        groups = []
+        req = self.api_get(query)
 
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
             return {"status": True, "groups": groups}
         if req.status_code == 404:
             return {"status": False, "groups": []}
@@ -285,15 +510,12 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def get_all_groups(self, **kwargs):
-        groups = []
-
         req = self.api_get(
             "/search?entity-type=group&max-results={}&start-index={}".format(
                 kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
 
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
 
             return {"status": True, "groups": groups}
         if req.status_code == 404:
@@ -302,18 +524,19 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def search_group(self, **kwargs):
-        groups = []
-
         if 'restriction' not in kwargs:
             raise ValueError("You need to define a certian restriction")
 
+        groups = self._search_locally("group", kwargs)
+        if groups is not None:
+            return {"status": True, "groups": groups}
+
         req = self.api_get(
             "/search?entity-type=group&restriction={}&max-results={}&start-index={}".format(
                 kwargs['restriction'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
 
         if req.status_code == 200:
-            for group in req.json()['groups']:
-                groups.append(group['name'])
+            groups = self.serializer.listing_names(req.content, 'groups')
 
             return {"status": True, "groups": groups}
         if req.status_code == 404:
@@ -322,14 +545,11 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def get_all_users(self, **kwargs):
-        users = []
-
         req = self.api_get(
             "/search?entity-type=user&max-results={}&start-index={}".format(
                 kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
         if req.status_code == 200:
-            for user in req.json()['users']:
-                users.append(user['name'])
+            users = self.serializer.listing_names(req.content, 'users')
 
             return {"status": True, "users": users}
         if req.status_code == 404:
@@ -338,17 +558,18 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def search_user(self, **kwargs):
-        users = []
-
         if 'restriction' not in kwargs:
             raise ValueError("You need to define a certain restriction")
 
+        users = self._search_locally("user", kwargs)
+        if users is not None:
+            return {"status": True, "users": users}
+
         req = self.api_get(
             "/search?entity-type=user&restriction={}&max-results={}&start-index={}".format(
                 kwargs['restriction'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)))
         if req.status_code == 200:
-            for user in req.json()['users']:
-                users.append(user['name'])
+            users = self.serializer.listing_names(req.content, 'users')
 
             return {"status": True, "users": users}
         if req.status_code == 404:
@@ -372,31 +593,107 @@ class CrowdAPI:
         req = self.api_post("/user/attribute?username={}".format(kwargs['username']), {
                             "attributes": [{"name": kwargs['attribute_name'], "values": kwargs['attribute_value']}]})
         if req.status_code == 204:
+            self._invalidate("user", kwargs['username'])
+            if self.local_search is not None:
+                self.local_search.set_attribute("user", kwargs['username'], kwargs['attribute_name'],
+                                                kwargs['attribute_value'])
             return {"status": True}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def set_user_activity(self, **kwargs):
+        """Activate or deactivate a user.
+
+        Pass the already fetched document as `user` (dict or User) to skip the
+        lookup; otherwise a cached document is reused when it came with an
+        ETag, and a fresh one is fetched without attributes when not. With an
+        ETag the update is conditional and is retried once against a fresh
+        document if the user changed meanwhile.
+        """
         if "username" not in kwargs:
             raise ValueError("Must pass username")
 
         if "active" not in kwargs:
             raise ValueError("Must pass active (true/false)")
 
-        # fetch current user document
-        user_document = self.api_get(
-            "/user?username={}".format(kwargs['username'])).json()
-
-        # set to active true/false
-        user_document["active"] = kwargs['active']
-
-        # update user object
-        req = self.api_put("/user?username={}".format(kwargs['username']), user_document )
+        user = kwargs.get('user')
+        etag = kwargs.get('etag')
+        if user is None:
+            # without an ETag a cached document could silently overwrite newer changes
+            res = self._cached_versioned_user(kwargs['username']) or \
+                self._get_user(username=kwargs['username'], expand=None)
+            if not res['status']:
+                return res if 'code' in res else {"status": False, "code": 404, "reason": b"USER_NOT_FOUND"}
+            user, etag = res['user'], res.get('etag')
+        elif isinstance(user, User):
+            user = user.to_json()
+
+        res = self._put_user(kwargs['username'], user, etag, active=kwargs['active'])
+        if not res['status'] and res['code'] == PRECONDITION_FAILED:
+            res = self._get_user(username=kwargs['username'], expand=None)
+            if not res['status']:
+                return res if 'code' in res else {"status": False, "code": 404, "reason": b"USER_NOT_FOUND"}
+            res = self._put_user(kwargs['username'], res['user'], res.get('etag'), active=kwargs['active'])
+        return res
+
+    def _cached_versioned_user(self, username):
+        if self.cache is None:
+            return None
+        for expand in (None, "attributes"):
+            res = self.cache.get(("user", username, expand))
+            if res is not None and res.get('etag'):
+                return res
+        return None
+
+    def _put_user(self, username, user, etag=None, **changes):
+        # PUT /user does not update attributes, so don't send them back
+        document = {k: v for k, v in user.items() if k not in ("attributes", "expand")}
+        document.update(changes)
+
+        req = self.api_put("/user?username={}".format(username), document,
+                           headers={"If-Match": etag} if etag else None)
         if req.status_code == 204:
+            self._invalidate("user", username)
+            if self.local_search is not None:
+                self.local_search.put("user", dict(document, name=user.get('name', username)))
+            if self.auth_cache is not None:
+                # a deactivated user must not keep authenticating from the cache
+                self.auth_cache.invalidate("auth", username.lower())
             return {"status": True}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
+    def set_users_activity(self, usernames, active, concurrency=8, chunk_size=50):
+        """Activate or deactivate many users.
+
+        The documents are fetched with batched searches and each one is PUT
+        back as soon as its chunk arrives, so lookups and updates overlap.
+        """
+        result = {"status": True, "updated": [], "missing": [], "errors": []}
+
+        def update(pair):
+            name, user = pair
+            if user is None:
+                return None
+            return self._put_user(user['name'], user, active=active)
+
+        try:
+            for (name, user), res in run_concurrently(
+                    update, self.iter_users(usernames, concurrency=concurrency, chunk_size=chunk_size), concurrency):
+                if res is None:
+                    result['missing'].append(name)
+                elif res['status']:
+                    result['updated'].append(name)
+                else:
+                    result['status'] = False
+                    result['errors'].append({"user": name, "code": res['code'], "reason": res['reason']})
+        except CrowdAPIError as e:
+            result['status'] = False
+            result['code'] = e.code
+            result['reason'] = e.reason
+
+        return result
+
     def create_user(self, **kwargs):
         user = {}
 
@@ -409,13 +706,22 @@ class CrowdAPI:
                 string.ascii_uppercase + string.digits) for _ in range(8))
             req_password_change = True
         else:
+            # Crowd expects {"value": ...}, a bare string is a convenience
+            if isinstance(user['password'], str):
+                user['password'] = {"value": user['password']}
             req_password_change = False
 
         user['active'] = True
 
         req = self.api_post("/user", user)
         if req.status_code == 201:
-            # user should change the password at their next login
+            # drop any cached "not found" answer
+            self._invalidate("user", user['name'])
+            if self.local_search is not None:
+                self.local_search.put("user", user)
+
+            # user should change the password at their next login; POST /user
+            # ignores attributes, so this needs its own request
             if req_password_change:
                 self.set_user_attribute(
                     username=user['name'], attribute_name="requiresPasswordChange", attribute_value=True)
@@ -426,9 +732,11 @@ class CrowdAPI:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
     def create_group(self, **kwargs):
-        req = self.api_post(
-            "/group", {"name": kwargs['name'], "type": "GROUP", "description": kwargs['description'], "active": True})
+        group = {"name": kwargs['name'], "type": "GROUP", "description": kwargs['description'], "active": True}
+        req = self.api_post("/group", group)
         if req.status_code == 201:
+            if self.local_search is not None:
+                self.local_search.put("group", group)
             return {"status": True}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
@@ -441,6 +749,13 @@ class CrowdAPI:
         req = self.api_delete(
             "/group?groupname={}".format(kwargs['groupname']), data={})
         if req.status_code == 204:
+            # the group may appear in any user's cached memberships
+            self._invalidate("user_groups")
+            self._invalidate("nested_user_groups")
+            if self.local_search is not None:
+                self.local_search.remove("group", kwargs['groupname'])
+            if self.membership_index is not None:
+                self.membership_index.invalidate()
             return {"status": True}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
@@ -456,6 +771,10 @@ class CrowdAPI:
         req = self.api_post(
             "/user/group/direct?username={}".format(kwargs['username']), {"name": kwargs['groupname']})
         if req.status_code == 201:
+            self._invalidate("user_groups", kwargs['username'])
+            self._invalidate("nested_user_groups", kwargs['username'])
+            if self.membership_index is not None:
+                self.membership_index.added(kwargs['username'], kwargs['groupname'])
             return {"status": True}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
@@ -470,15 +789,394 @@ class CrowdAPI:
 
         req = self.api_delete(
             "/user/group/direct?username={}&groupname={}".format(kwargs['username'], kwargs['groupname']), data={})
+        if req.status_code == 204:
+            self._invalidate("user_groups", kwargs['username'])
+            self._invalidate("nested_user_groups", kwargs['username'])
+            if self.membership_index is not None:
+                self.membership_index.removed(kwargs['username'], kwargs['groupname'])
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def is_user_in_group(self, **kwargs):
+        """Check a single (nested or direct) membership, returning {"status": True, "member": bool}.
+
+        With a membership index the answer usually comes from memory; otherwise,
+        or when the index is unsure, only this one membership is asked for.
+        """
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        nested = kwargs.get('nested', False)
+        if self.membership_index is not None:
+            member = self.membership_index.check(kwargs['username'], kwargs['groupname'], nested)
+            if member is not None:
+                return {"status": True, "member": member}
+
+        req = self.api_get("/group/user/{}?".format("nested" if nested else "direct") + urlencode(
+            {"groupname": kwargs['groupname'], "username": kwargs['username']}))
+        if req.status_code == 200:
+            return {"status": True, "member": True}
+        if req.status_code == 404:
+            # unknown users and groups have no members either
+            return {"status": True, "member": False}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def _factors(self, kwargs):
+        factors = kwargs.get('validation_factors') or {}
+        return [{"name": k, "value": v} for k, v in sorted(factors.items())]
+
+    def _factor_values(self, kwargs):
+        return [f['value'] for f in self._factors(kwargs)]
+
+    def _cache_session(self, token, session, kwargs):
+        # the cache only keeps a hash of the token, so keep it out of the cached value too
+        if self.auth_cache is not None:
+            self.auth_cache.set("session", token, {k: v for k, v in session.items() if k != 'token'},
+                                *self._factor_values(kwargs))
+
+    def authenticate_user(self, **kwargs):
+        """Check a user's password, returning the user document on success.
+
+        With auth_cache_ttl set, successful checks are remembered for that
+        many seconds.
+        """
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "password" not in kwargs:
+            raise ValueError("Must pass password")
+
+        if self.auth_cache is not None:
+            res = self.auth_cache.get("auth", kwargs['username'].lower(), kwargs['password'])
+            if res is not None:
+                return res
+
+        req = self.api_post("/authentication?" + urlencode({"username": kwargs['username']}),
+                            {"value": kwargs['password']})
+        if req.status_code == 200:
+            res = {"status": True, "user": self.serializer.loads(req.content)}
+            if self.auth_cache is not None:
+                self.auth_cache.set("auth", kwargs['username'].lower(), res, kwargs['password'])
+            return res
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def create_session(self, **kwargs):
+        """Authenticate a user and open an SSO session, returning its token.
+
+        Optional `validation_factors` (e.g. {"remote_address": "10.0.0.1"})
+        are bound to the session and must be passed again to validate it.
+        """
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "password" not in kwargs:
+            raise ValueError("Must pass password")
+
+        req = self.api_post("/session", {
+            "username": kwargs['username'], "password": kwargs['password'],
+            "validation-factors": {"validationFactors": self._factors(kwargs)}})
+        if req.status_code == 201:
+            session = self.serializer.loads(req.content)
+            self._cache_session(session['token'], session, kwargs)
+            return {"status": True, "token": session['token'], "session": session}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def validate_session(self, **kwargs):
+        """Check an SSO session token, returning the session (with its user) while it is valid.
+
+        Cached validations are not seen by Crowd, so they do not extend the
+        session's idle timeout.
+        """
+        if "token" not in kwargs:
+            raise ValueError("Must pass token")
+
+        if self.auth_cache is not None:
+            session = self.auth_cache.get("session", kwargs['token'], *self._factor_values(kwargs))
+            if session is not None:
+                return {"status": True, "token": kwargs['token'], "session": dict(session, token=kwargs['token'])}
+
+        req = self.api_post("/session/{}".format(kwargs['token']), {"validationFactors": self._factors(kwargs)},
+                            endpoint="/session/{token}")
+        if req.status_code == 200:
+            session = self.serializer.loads(req.content)
+            self._cache_session(kwargs['token'], session, kwargs)
+            return {"status": True, "token": session.get('token', kwargs['token']), "session": session}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def invalidate_session(self, **kwargs):
+        """Log an SSO session out, dropping it from the cache as well."""
+        if "token" not in kwargs:
+            raise ValueError("Must pass token")
+
+        if self.auth_cache is not None:
+            self.auth_cache.invalidate("session", kwargs['token'])
+
+        req = self.api_delete("/session/{}".format(kwargs['token']), data=None, endpoint="/session/{token}")
         if req.status_code == 204:
             return {"status": True}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
 
+    def get_event_token(self):
+        """Get a token marking the current position in the directory change feed."""
+        req = self.api_get("/event")
+        if req.status_code == 200:
+            return {"status": True, "token": self.serializer.loads(req.content)['newEventToken']}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def get_events(self, **kwargs):
+        """Get the directory changes since the given event token, and the token to resume from."""
+        if "token" not in kwargs:
+            raise ValueError("Must pass token")
+
+        req = self.api_get("/event/{}".format(kwargs['token']), endpoint="/event/{token}")
+        if req.status_code == 200:
+            feed = self.serializer.loads(req.content)
+            return {"status": True, "token": feed['newEventToken'], "events": feed.get('events', [])}
+        else:
+            # 410 when the token expired or the feed was reset
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
     def get_group(self, **kwargs):
+        """Fetch a group document, with its attributes unless `expand` is None."""
+        expand = kwargs.get('expand', "attributes")
         req = self.api_get(
-            "/group?groupname={}&expand=attributes".format(kwargs['name']))
+            "/group?groupname={}".format(kwargs['name']) + ("&expand={}".format(expand) if expand else ""))
         if req.status_code == 200:
-            return {"status": True, "group": req.json()}
+            group = self.serializer.loads(req.content)
+            if kwargs.get('as_model'):
+                return {"status": True, "group": Group.from_json(group, self._attribute_loader("group", group))}
+            return {"status": True, "group": group}
         else:
             return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def _fetch_page(self, method, key, start_index, page_size, **kwargs):
+        res = method(start_index=start_index, max_results=page_size, **kwargs)
+        if not res['status'] and 'code' in res:
+            raise CrowdAPIError(res['code'], res['reason'])
+        if self.intern_names:
+            return [sys.intern(name) for name in res[key]]
+        return res[key]
+
+    def _iter_pages(self, method, key, page_size=1000, prefetch=False, **kwargs):
+        """Walk a paged listing method, yielding the entries of each page as it arrives.
+
+        With prefetch enabled the next page is requested in a background thread
+        while the current one is being consumed.
+        """
+        def fetch(start_index):
+            return self._fetch_page(method, key, start_index, page_size, **kwargs)
+
+        start_index = 0
+
+        if not prefetch:
+            while True:
+                page = fetch(start_index)
+                yield from page
+                if len(page) < page_size:
+                    return
+                start_index += page_size
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch, start_index)
+            while True:
+                page = future.result()
+                if len(page) < page_size:
+                    yield from page
+                    return
+                start_index += page_size
+                future = executor.submit(fetch, start_index)
+                yield from page
+
+    def iter_all_users(self, page_size=1000, prefetch=False):
+        return self._iter_pages(self.get_all_users, "users", page_size, prefetch)
+
+    def iter_all_groups(self, page_size=1000, prefetch=False):
+        return self._iter_pages(self.get_all_groups, "groups", page_size, prefetch)
+
+    def iter_search_user(self, restriction, page_size=1000, prefetch=False):
+        return self._iter_pages(self.search_user, "users", page_size, prefetch, restriction=restriction)
+
+    def iter_search_group(self, restriction, page_size=1000, prefetch=False):
+        return self._iter_pages(self.search_group, "groups", page_size, prefetch, restriction=restriction)
+
+    def iter_group_users(self, groupname, page_size=1000, prefetch=False):
+        return self._iter_pages(self.get_group_users, "users", page_size, prefetch, groupname=groupname)
+
+    def iter_nested_group_users(self, groupname, page_size=1000, prefetch=False):
+        return self._iter_pages(self.get_nested_group_users, "users", page_size, prefetch, groupname=groupname)
+
+    def iter_user_groups(self, username, page_size=1000, prefetch=False):
+        return self._iter_pages(self.get_user_groups, "groups", page_size, prefetch, username=username)
+
+    def iter_direct_children_of_group(self, groupname, page_size=1000, prefetch=False):
+        return self._iter_pages(self.get_direct_children_of_group, "groups", page_size, prefetch, groupname=groupname)
+
+    def _get_all_entities(self, **kwargs):
+        """One page of full entity documents, attributes included, from /search rather than just their names."""
+        entity_type = kwargs['entity_type']
+        key = entity_type + "s"
+
+        req = self.api_get("/search?" + urlencode({
+            "entity-type": entity_type, "expand": entity_type + ",attributes",
+            "max-results": kwargs.get('max_results', 1000), "start-index": kwargs.get('start_index', 0)}))
+        if req.status_code == 200:
+            return {"status": True, key: self.serializer.loads(req.content)[key]}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def iter_all_user_entities(self, page_size=1000, prefetch=False):
+        """Like iter_all_users, but yields full user documents."""
+        return self._iter_pages(self._get_all_entities, "users", page_size, prefetch, entity_type="user")
+
+    def iter_all_group_entities(self, page_size=1000, prefetch=False):
+        """Like iter_all_groups, but yields full group documents."""
+        return self._iter_pages(self._get_all_entities, "groups", page_size, prefetch, entity_type="group")
+
+    def _export_pages(self, method, key, page_size=1000, workers=4, **kwargs):
+        """Fetch every page of a listing concurrently and return them in order.
+
+        Up to `workers` pages are requested ahead at known offsets; the walk
+        stops at the first short page and any requests past it are cancelled.
+        """
+        entries = []
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            start_index = 0
+
+            for _ in range(workers):
+                pending.append(executor.submit(self._fetch_page, method, key, start_index, page_size, **kwargs))
+                start_index += page_size
+
+            try:
+                while True:
+                    page = pending.popleft().result()
+                    entries.extend(page)
+                    if len(page) < page_size:
+                        break
+                    pending.append(executor.submit(self._fetch_page, method, key, start_index, page_size, **kwargs))
+                    start_index += page_size
+            except CrowdAPIError as e:
+                return {"status": False, "code": e.code, "reason": e.reason}
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        return {"status": True, key: entries}
+
+    def export_all_users(self, page_size=1000, workers=4):
+        """Same result as walking get_all_users page by page, fetched in parallel."""
+        return self._export_pages(self.get_all_users, "users", page_size, workers)
+
+    def export_all_groups(self, page_size=1000, workers=4):
+        """Same result as walking get_all_groups page by page, fetched in parallel."""
+        return self._export_pages(self.get_all_groups, "groups", page_size, workers)
+
+    def bulk_provision(self, users, concurrency=8):
+        """Create missing users and group memberships for a list of user definitions, in parallel.
+
+        See crowd_api.provision.provision_user for the definition format.
+        """
+        return provision.bulk_provision(self, users, concurrency)
+
+    def add_users_to_group(self, groupname, usernames, concurrency=8):
+        """Add many users to a group in parallel, returning the added, unchanged and failed users."""
+        return membership.add_users_to_group(self, groupname, usernames, concurrency)
+
+    def remove_users_from_group(self, groupname, usernames, concurrency=8):
+        """Remove many users from a group in parallel, returning the removed, unchanged and failed users."""
+        return membership.remove_users_from_group(self, groupname, usernames, concurrency)
+
+    def set_group_members(self, groupname, usernames, concurrency=8, page_size=1000):
+        """Replace the direct members of a group, only sending the adds and removes needed."""
+        return membership.set_group_members(self, groupname, usernames, concurrency, page_size)
+
+    def _iter_by_names(self, entity_type, names, expand=None, concurrency=8, chunk_size=50):
+        """Fetch entities by name using chunked `name = "a" or name = "b"` searches, fanned out over a pool.
+
+        Names that cannot be safely quoted in CQL or hold a wildcard, and
+        chunks the server refuses to search, fall back to one GET per name.
+        """
+        key = entity_type + "s"
+        names = list(dict.fromkeys(names))
+
+        # "*" is a CQL wildcard, a name holding one could match (and crowd out) other entities
+        quotable = [n for n in names if not any(c in n for c in '"\\*')]
+        unquotable = [n for n in names if any(c in n for c in '"\\*')]
+
+        def fetch_one(name):
+            if entity_type == "user":
+                res = self.get_user(username=name)
+                return res.get('user'), res
+            res = self.get_group(name=name)
+            return res.get('group'), res
+
+        def fetch_chunk(chunk):
+            params = {"entity-type": entity_type,
+                      "restriction": " or ".join('name = "{}"'.format(n) for n in chunk),
+                      "max-results": len(chunk),
+                      "expand": entity_type + (",attributes" if expand == "attributes" else "")}
+            req = self.api_get("/search?" + urlencode(params))
+            if req.status_code != 200:
+                return [(name,) + fetch_one(name) for name in chunk]
+
+            # Crowd matches names case-insensitively
+            found = {e['name'].lower(): e for e in self.serializer.loads(req.content)[key]}
+            return [(name, found.get(name.lower()), None) for name in chunk]
+
+        work = [quotable[i:i + chunk_size] for i in range(0, len(quotable), chunk_size)]
+        work += [[name] for name in unquotable]
+
+        for _, results in run_concurrently(fetch_chunk, work, concurrency):
+            for name, entity, res in results:
+                if entity is None and res is not None and res.get('code', 404) != 404:
+                    raise CrowdAPIError(res['code'], res['reason'])
+                yield name, entity
+
+    def iter_users(self, usernames, expand=None, concurrency=8, chunk_size=50):
+        """Yield (username, user) pairs as they arrive; user is None when it does not exist."""
+        return self._iter_by_names("user", usernames, expand, concurrency, chunk_size)
+
+    def iter_groups(self, names, expand=None, concurrency=8, chunk_size=50):
+        """Yield (name, group) pairs as they arrive; group is None when it does not exist."""
+        return self._iter_by_names("group", names, expand, concurrency, chunk_size)
+
+    def get_users(self, usernames, expand=None, concurrency=8, chunk_size=50, as_model=False):
+        """Fetch many users at once; pass expand="attributes" to include their attributes."""
+        users = {}
+        missing = []
+        try:
+            for name, user in self.iter_users(usernames, expand, concurrency, chunk_size):
+                if user is None:
+                    missing.append(name)
+                else:
+                    users[name] = User.from_json(user, self._attribute_loader("user", user)) if as_model else user
+        except CrowdAPIError as e:
+            return {"status": False, "code": e.code, "reason": e.reason}
+
+        return {"status": True, "users": users, "missing": missing}
+
+    def get_groups(self, names, expand=None, concurrency=8, chunk_size=50, as_model=False):
+        """Fetch many groups at once; pass expand="attributes" to include their attributes."""
+        groups = {}
+        missing = []
+        try:
+            for name, group in self.iter_groups(names, expand, concurrency, chunk_size):
+                if group is None:
+                    missing.append(name)
+                else:
+                    groups[name] = Group.from_json(group, self._attribute_loader("group", group)) if as_model else group
+        except CrowdAPIError as e:
+            return {"status": False, "code": e.code, "reason": e.reason}
+
+        return {"status": True, "groups": groups, "missing": missing}
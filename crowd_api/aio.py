@@ -0,0 +1,377 @@
+#
+# aio.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import asyncio
+import json
+import random
+import string
+from urllib.parse import urlencode
+
+from .serializers import default_serializer
+from .singleflight import AsyncSingleFlight, normalize_query
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse:
+    """Fully read HTTP response, exposing the bits of requests.Response the API methods use."""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncCrowdAPI:
+    def __init__(self, **kwargs):
+        if aiohttp is None:
+            raise ImportError("AsyncCrowdAPI requires the aiohttp package")
+
+        if 'api_url' not in kwargs:
+            raise ValueError("Crowd API URL must be given")
+
+        self.api_url = kwargs['api_url']
+
+        if 'app_name' not in kwargs:
+            raise ValueError("Crowd API application name must be given")
+
+        if 'app_password' not in kwargs:
+            raise ValueError("Crowd API application password must be given")
+
+        self.auth = (kwargs['app_name'], kwargs['app_password'])
+        self.verify_ssl = kwargs.get('verify_ssl', False)
+        self.timeout = kwargs.get('timeout', 10)
+        self.max_concurrency = kwargs.get('max_concurrency', 100)
+        self.compression = kwargs.get('compression', True)
+
+        self.session = None
+        self.semaphore = None
+
+        # share one response among concurrent identical GETs
+        self.singleflight = AsyncSingleFlight() if kwargs.get('coalesce', False) else None
+
+        # JSON backend for request bodies and responses, orjson when installed
+        self.serializer = kwargs.get('serializer') or default_serializer()
+
+    def _get_session(self):
+        # the session and semaphore must be created from within a running event
+        # loop, before Python 3.10 they bind to the loop current at creation
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            headers = {"Content-Type": "application/json", "Accept": "application/json"}
+            if not self.compression:
+                headers['Accept-Encoding'] = "identity"
+            self.session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(*self.auth),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, ssl=None if self.verify_ssl else False))
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _request(self, method, query, data=None):
+        kwargs = {}
+        if data is not None:
+            kwargs['data'] = self.serializer.dumps(data)
+
+        session = self._get_session()
+        async with self.semaphore:
+            async with session.request(method, self.api_url + query, **kwargs) as resp:
+                content = await resp.read()
+                return AsyncResponse(resp.status, content, resp.headers)
+
+    async def api_get(self, query):
+        if self.singleflight is not None:
+            return await self.singleflight.do(normalize_query(query), lambda: self._request("GET", query))
+        return await self._request("GET", query)
+
+    async def api_post(self, query, data):
+        return await self._request("POST", query, data)
+
+    async def api_put(self, query, data):
+        return await self._request("PUT", query, data)
+
+    async def api_delete(self, query, data):
+        return await self._request("DELETE", query, data)
+
+    async def _get_names(self, query, key):
+        req = await self.api_get(query)
+        if req.status_code == 200:
+            return {"status": True, key: self.serializer.listing_names(req.content, key)}
+        if req.status_code == 404:
+            return {"status": False, key: []}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    def _paged_query(self, endpoint, params, **kwargs):
+        if kwargs.get('max_results') is not None:
+            params['max-results'] = kwargs.get('max_results')
+        if kwargs.get('start_index') is not None:
+            params['start-index'] = kwargs.get('start_index')
+
+        return f"{endpoint}?{urlencode(params)}"
+
+    async def get_user(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        expand = kwargs.get('expand', "attributes")
+        req = await self.api_get(
+            "/user?username={}".format(kwargs['username']) + ("&expand={}".format(expand) if expand else ""))
+        if req.status_code == 200:
+            return {"status": True, "user": self.serializer.loads(req.content)}
+        if req.status_code == 404:
+            return {"status": False, "user": None}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def get_user_attributes(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        req = await self.api_get("/user/attribute?username={}".format(kwargs['username']))
+        if req.status_code == 200:
+            return {"status": True, "Attributes": req.content}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def get_user_groups(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        return await self._get_names("/user/group/direct?username={}&max-results={}&start-index={}".format(
+            kwargs['username'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)), "groups")
+
+    async def get_nested_user_groups(self, **kwargs) -> dict:
+        """Retrieve the group that the user is a nested member of."""
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        return await self._get_names(self._paged_query(
+            "/user/group/nested", {'username': kwargs['username']}, **kwargs), "groups")
+
+    async def get_group_users(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        return await self._get_names("/group/user/direct?groupname={}&max-results={}&start-index={}".format(
+            kwargs['groupname'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)), "users")
+
+    async def get_nested_group_users(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        return await self._get_names(
+            "/group/user/nested?groupname={}".format(kwargs['groupname']), "users")
+
+    async def get_parent_groups(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        res = await self._get_names(
+            "/group/parent-group/direct?groupname={}".format(kwargs['groupname']), "groups")
+        if "groups" in res:
+            res["pgroups"] = res.pop("groups")
+        return res
+
+    async def get_parent_groupsv2(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        return await self._get_names(
+            "/group/parent-group/direct?groupname={}".format(kwargs['groupname']), "groups")
+
+    async def get_nested_parent_groups(self, **kwargs) -> dict:
+        """Retrieve the groups that are nested parents of the specified group."""
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        return await self._get_names(self._paged_query(
+            "/group/parent-group/nested", {'groupname': kwargs['groupname']}, **kwargs), "groups")
+
+    async def get_direct_children_of_group(self, **kwargs) -> dict:
+        """Retrieve the groups that are direct children of the specified group."""
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        return await self._get_names(self._paged_query(
+            "/group/child-group/direct", {'groupname': kwargs['groupname']}, **kwargs), "groups")
+
+    async def get_nested_children_of_group(self, **kwargs) -> dict:
+        """Retrieve nested children of the specified group."""
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        return await self._get_names(self._paged_query(
+            "/group/child-group/nested", {'groupname': kwargs['groupname']}, **kwargs), "groups")
+
+    async def get_all_groups(self, **kwargs):
+        return await self._get_names(
+            "/search?entity-type=group&max-results={}&start-index={}".format(
+                kwargs.get('max_results', 1000), kwargs.get('start_index', 0)), "groups")
+
+    async def search_group(self, **kwargs):
+        if 'restriction' not in kwargs:
+            raise ValueError("You need to define a certain restriction")
+
+        return await self._get_names(
+            "/search?entity-type=group&restriction={}&max-results={}&start-index={}".format(
+                kwargs['restriction'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)), "groups")
+
+    async def get_all_users(self, **kwargs):
+        return await self._get_names(
+            "/search?entity-type=user&max-results={}&start-index={}".format(
+                kwargs.get('max_results', 1000), kwargs.get('start_index', 0)), "users")
+
+    async def search_user(self, **kwargs):
+        if 'restriction' not in kwargs:
+            raise ValueError("You need to define a certain restriction")
+
+        return await self._get_names(
+            "/search?entity-type=user&restriction={}&max-results={}&start-index={}".format(
+                kwargs['restriction'], kwargs.get('max_results', 1000), kwargs.get('start_index', 0)), "users")
+
+    async def set_user_attribute(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "attribute_name" not in kwargs:
+            raise ValueError("Must pass attribute_name")
+
+        if "attribute_value" not in kwargs:
+            raise ValueError("Must pass attribute_value")
+        else:
+            if not isinstance(kwargs['attribute_value'], list):
+                kwargs['attribute_value'] = [kwargs['attribute_value']]
+
+        req = await self.api_post("/user/attribute?username={}".format(kwargs['username']), {
+                                  "attributes": [{"name": kwargs['attribute_name'], "values": kwargs['attribute_value']}]})
+        if req.status_code == 204:
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def set_user_activity(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "active" not in kwargs:
+            raise ValueError("Must pass active (true/false)")
+
+        # fetch current user document
+        user_document = self.serializer.loads((await self.api_get(
+            "/user?username={}".format(kwargs['username']))).content)
+
+        # set to active true/false
+        user_document["active"] = kwargs['active']
+
+        # update user object
+        req = await self.api_put("/user?username={}".format(kwargs['username']), user_document)
+        if req.status_code == 204:
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def create_user(self, **kwargs):
+        user = {}
+
+        for k, v in kwargs.items():
+            user[k.replace('_', '-')] = v
+
+        if 'password' not in kwargs:
+            user['password'] = {}
+            user['password']['value'] = ''.join(random.choice(
+                string.ascii_uppercase + string.digits) for _ in range(8))
+            req_password_change = True
+        else:
+            req_password_change = False
+
+        user['active'] = True
+
+        req = await self.api_post("/user", user)
+        if req.status_code == 201:
+            # user should change the password at their next login
+            if req_password_change:
+                await self.set_user_attribute(
+                    username=user['name'], attribute_name="requiresPasswordChange", attribute_value=True)
+                return {"status": True, "password": user['password']['value']}
+            else:
+                return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def create_group(self, **kwargs):
+        req = await self.api_post(
+            "/group", {"name": kwargs['name'], "type": "GROUP", "description": kwargs['description'], "active": True})
+        if req.status_code == 201:
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def delete_group(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        req = await self.api_delete(
+            "/group?groupname={}".format(kwargs['groupname']), data={})
+        if req.status_code == 204:
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def add_user_to_group(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        req = await self.api_post(
+            "/user/group/direct?username={}".format(kwargs['username']), {"name": kwargs['groupname']})
+        if req.status_code == 201:
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def remove_user_from_group(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+
+        req = await self.api_delete(
+            "/user/group/direct?username={}&groupname={}".format(kwargs['username'], kwargs['groupname']), data={})
+        if req.status_code == 204:
+            return {"status": True}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
+
+    async def get_group(self, **kwargs):
+        expand = kwargs.get('expand', "attributes")
+        req = await self.api_get(
+            "/group?groupname={}".format(kwargs['name']) + ("&expand={}".format(expand) if expand else ""))
+        if req.status_code == 200:
+            return {"status": True, "group": self.serializer.loads(req.content)}
+        else:
+            return {"status": False, "code": req.status_code, "reason": req.content}
@@ -0,0 +1,44 @@
+#
+# auth.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import hashlib
+import hmac
+import os
+
+from .cache import TTLCache
+
+
+class AuthCache:
+    """Short-lived cache of successful authentications and validated session tokens.
+
+    Credentials and tokens never appear in the cache: entries are keyed on
+    an HMAC of them with a random per-process salt and callers store values
+    without them, so a dump of the cache cannot be replayed or brute-forced
+    offline.
+    """
+
+    def __init__(self, ttl=30, maxsize=10000):
+        self.ttl = ttl
+        self.cache = TTLCache(maxsize=maxsize)
+        self._salt = os.urandom(32)
+
+    def _hash(self, *parts):
+        return hmac.new(self._salt, "\0".join(parts).encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def _key(self, kind, secret, extra):
+        return (kind, self._hash(secret), self._hash(*extra) if extra else None)
+
+    def get(self, kind, secret, *extra):
+        return self.cache.get(self._key(kind, secret, extra))
+
+    def set(self, kind, secret, value, *extra):
+        self.cache.set(self._key(kind, secret, extra), value, self.ttl)
+
+    def invalidate(self, kind, secret=None):
+        self.cache.invalidate(kind, None if secret is None else self._hash(secret))
+
+    def stats(self):
+        return self.cache.stats()
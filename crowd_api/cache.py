@@ -0,0 +1,98 @@
+#
+# cache.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+
+def _fold(name):
+    return name.lower() if isinstance(name, str) else name
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a per-entry TTL.
+
+    Keys are tuples whose first two items are the entity kind and name, so
+    every cached page for a given entity can be invalidated at once. Names
+    are matched case-insensitively, like Crowd's.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # kind -> lowercased name -> keys, so invalidation doesn't scan the whole cache
+        self._index = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key not in self._data:
+                self._index.setdefault(key[0], {}).setdefault(_fold(key[1]), set()).add(key)
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        names = self._index[key[0]]
+        keys = names[_fold(key[1])]
+        keys.discard(key)
+        if not keys:
+            del names[_fold(key[1])]
+
+    def invalidate(self, kind, name=None):
+        """Drop every entry of the given kind, optionally only for one entity name."""
+        with self._lock:
+            names = self._index.get(kind)
+            if not names:
+                return
+            if name is None:
+                keys = [k for ks in names.values() for k in ks]
+            else:
+                keys = list(names.get(_fold(name), ()))
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._index.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expirations": self.expirations}
@@ -0,0 +1,280 @@
+#
+# cli.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import argparse
+import csv
+import json
+import logging
+import os
+import queue
+import smtplib
+import sys
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from .executor import run_concurrently
+from .provision import try_provision_user
+
+logger = logging.getLogger("crowd_api.onboard")
+
+
+def iter_user_definitions(path, fmt=None):
+    """Stream user definitions from a JSON Lines, CSV or (legacy) JSON array file.
+
+    CSV files need a header row with the definition keys (name, first-name,
+    last-name, display-name, email); the optional groups column holds
+    comma-separated group names.
+    """
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {".csv": "csv", ".json": "json"}.get(ext, "jsonl")
+
+    with open(path, 'r', newline='' if fmt == "csv" else None) as fd:
+        if fmt == "json":
+            # a single array can't be streamed, kept for the old users.json files
+            yield from json.load(fd)
+        elif fmt == "csv":
+            reader = csv.DictReader(fd)
+            for row in reader:
+                if None in row:
+                    # more fields than the header, e.g. an unquoted groups list
+                    logger.error("Skipping malformed row at line %d of %s", reader.line_num, path)
+                    continue
+                user = {k: v for k, v in row.items() if v not in (None, "")}
+                user['groups'] = [g.strip() for g in (row.get('groups') or "").split(",") if g.strip()]
+                yield user
+        else:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class Checkpoint:
+    """Append-only log of the users already onboarded, so an interrupted run can resume."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        self._fd = None
+
+        if path is not None:
+            if os.path.exists(path):
+                with open(path, 'r') as fd:
+                    self.done = set(line.rstrip("\n") for line in fd if line.strip())
+            self._fd = open(path, 'a')
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def add(self, name):
+        if self._fd is None:
+            return
+        with self._lock:
+            self._fd.write(name + "\n")
+            self._fd.flush()
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+
+
+class SMTPPool:
+    """A few SMTP connections reused across messages and worker threads, opened on demand."""
+
+    def __init__(self, host, size=4):
+        self.host = host
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+
+    def _connect(self):
+        return smtplib.SMTP(self.host)
+
+    def sendmail(self, sender, recipients, message):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+
+            try:
+                try:
+                    conn.sendmail(sender, recipients, message)
+                except smtplib.SMTPServerDisconnected:
+                    # idle connections get dropped by the server, retry once on a fresh one
+                    conn = self._connect()
+                    conn.sendmail(sender, recipients, message)
+            except Exception:
+                # the session may be left mid-transaction, don't hand it to the next message
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.quit()
+            except smtplib.SMTPException:
+                pass
+
+
+class Notifier:
+    """Render the welcome e-mail from one compiled template and send it through an SMTPPool."""
+
+    def __init__(self, opts):
+        import jinja2
+
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(searchpath=opts.template_dir))
+        self.template = env.get_template(opts.template)
+        self.opts = opts
+        self.smtp = SMTPPool(opts.mail_server, opts.smtp_connections)
+
+    def notify(self, user):
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = self.opts.mail_subject
+        msg['From'] = self.opts.mail_sender
+        msg['To'] = user['email']
+        if self.opts.mail_recipients_cc:
+            msg['Cc'] = ",".join(self.opts.mail_recipients_cc)
+        msg.attach(MIMEText(self.template.render(opts=self.opts, user=user)))
+
+        recipients = self.opts.mail_recipients_cc + self.opts.mail_recipients_bcc + [user['email']]
+        self.smtp.sendmail(self.opts.mail_sender, recipients, msg.as_string())
+
+    def close(self):
+        self.smtp.close()
+
+
+def onboard(crowd, users, workers=8, checkpoint=None, notifier=None):
+    """Provision a stream of user definitions over a bounded worker pool, returning per-outcome counts."""
+    checkpoint = checkpoint or Checkpoint(None)
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0, "failed": 0}
+
+    def pending():
+        for user in users:
+            if user['name'] in checkpoint:
+                counts['skipped'] += 1
+            else:
+                yield user
+
+    def work(user):
+        # an unexpected error fails this user only, not the whole run
+        result = try_provision_user(crowd, user)
+        if result['status'] and result['created'] and notifier is not None and user.get('email'):
+            try:
+                notifier.notify(dict(user, password=result.get('password')))
+            except Exception as e:
+                logger.error("Failed to notify user %s via e-mail: %s", user['name'], e)
+        return result
+
+    for user, result in run_concurrently(work, pending(), workers):
+        if not result['status']:
+            counts['failed'] += 1
+            for error in result['errors']:
+                logger.error("Failed to onboard user %s (%s: %s %s)", user['name'], error['op'], error['code'],
+                             error['reason'])
+            continue
+
+        checkpoint.add(user['name'])
+        if result['created']:
+            counts['created'] += 1
+            logger.info("Created user %s", user['name'])
+        elif result['groups_added']:
+            counts['updated'] += 1
+            logger.info("User %s already exists, added to %s", user['name'], ", ".join(result['groups_added']))
+        else:
+            counts['unchanged'] += 1
+            logger.debug("User %s is up to date", user['name'])
+
+    return counts
+
+
+def parse_opts(argv=None):
+    parser = argparse.ArgumentParser(description='Onboard Crowd users from a JSON Lines or CSV file')
+    parser.add_argument("--crowd-url", action="store", dest="crowd_url", default="http://127.0.0.1/crowd", help="Crowd front-end URL (default: %(default)s)")
+    parser.add_argument("--api-url", action="store", dest="api_url", default="http://127.0.0.1/crowd/rest/usermanagement/latest", help="API URL (default: %(default)s)")
+    parser.add_argument("--app-name", action="store", dest="app_name", help="Application name")
+    parser.add_argument("--app-password", action="store", dest="app_password", help="Application password")
+    parser.add_argument("--no-ssl-verify", action="store_false", dest="verify_ssl", help="Disable SSL verification")
+    parser.add_argument("--users", "--users-json", action="store", dest="users", help="Users file (.jsonl, .csv or a .json array)")
+    parser.add_argument("--format", action="store", dest="format", choices=["jsonl", "csv", "json"], help="Users file format (default: from the extension)")
+    parser.add_argument("--workers", type=int, default=8, help="Users provisioned concurrently (default: %(default)s)")
+    parser.add_argument("--checkpoint", action="store", dest="checkpoint", help="File recording onboarded users, to resume an interrupted run")
+    parser.add_argument("--notify-email", action="store_true", default=False, dest="notify_email", help="Enable E-Mail notification upon user creation")
+    parser.add_argument("--template-dir", action="store", dest="template_dir", default="./templates", help="E-mail template directory (default: %(default)s)")
+    parser.add_argument("--template", action="store", dest="template", default="new_user.jinja", help="E-mail template (default: %(default)s)")
+    parser.add_argument("--mail-subject", action="store", dest="mail_subject", default="Crowd account setup", help="E-mail subject (default: %(default)s)")
+    parser.add_argument("--mail-sender", action="store", dest="mail_sender", default="crowd@localhost", help="E-mail sender (default: %(default)s)")
+    parser.add_argument("--mail-recipients-cc", action="store", dest="mail_recipients_cc", help="E-mail recipients to CC")
+    parser.add_argument("--mail-recipients-bcc", action="store", dest="mail_recipients_bcc", help="E-mail recipients to BCC")
+    parser.add_argument("--mail-server", action="store", dest="mail_server", default="localhost", help="Mail server host (default: %(default)s)")
+    parser.add_argument("--smtp-connections", type=int, default=4, dest="smtp_connections", help="SMTP connections kept open (default: %(default)s)")
+    parser.add_argument("-c", "--config", action="store", dest="config_file", default="./crowd.yaml", help="Optional configuration file to read options from (default: %(default)s)")
+    parser.add_argument("-l", "--log-level", action="store", dest="loglevel", default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Set the logging level (default: %(default)s)")
+    opts = parser.parse_args(argv)
+
+    if os.path.isfile(opts.config_file):
+        try:
+            import yaml
+        except ImportError:
+            parser.error("Reading " + opts.config_file + " requires the pyyaml package")
+        with open(opts.config_file, 'r') as stream:
+            data = yaml.safe_load(stream)
+        for k, v in (data or {}).items():
+            # the old example used users_json and ssl_verify
+            k = {"users_json": "users", "ssl_verify": "verify_ssl"}.get(k, k)
+            setattr(opts, k, v)
+
+    if not opts.app_name or not opts.app_password:
+        parser.error("Application name and password are required to authenticate against Crowd")
+
+    if opts.users is None:
+        parser.error("Please provide a file with the users definitions")
+
+    if opts.notify_email:
+        try:
+            import jinja2  # noqa: F401
+        except ImportError:
+            parser.error("E-mail notifications require the jinja2 package")
+
+    # normalize cc and bcc
+    for attr in ("mail_recipients_cc", "mail_recipients_bcc"):
+        value = getattr(opts, attr)
+        setattr(opts, attr, [r for r in value.split(',') if r] if isinstance(value, str) else list(value or []))
+
+    return opts
+
+
+def main(argv=None):
+    from . import CrowdAPI
+
+    opts = parse_opts(argv)
+
+    logging.basicConfig(format='[%(asctime)s] %(levelname)s - %(name)s: %(message)s', level=getattr(logging, opts.loglevel))
+
+    notifier = Notifier(opts) if opts.notify_email else None
+    checkpoint = Checkpoint(opts.checkpoint)
+    try:
+        with CrowdAPI(api_url=opts.api_url, app_name=opts.app_name, app_password=opts.app_password,
+                      verify_ssl=opts.verify_ssl, pool_maxsize=max(10, opts.workers)) as crowd:
+            counts = onboard(crowd, iter_user_definitions(opts.users, opts.format), opts.workers, checkpoint, notifier)
+    finally:
+        checkpoint.close()
+        if notifier is not None:
+            notifier.close()
+
+    logger.info("%(created)d created, %(updated)d updated, %(unchanged)d unchanged, %(skipped)d skipped, "
+                "%(failed)d failed", counts)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,25 @@
+#
+# exceptions.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+
+class CrowdAPIError(Exception):
+    """Raised by the streaming helpers when Crowd answers with an unexpected status."""
+
+    def __init__(self, code, reason):
+        super().__init__("Crowd API returned {}: {}".format(code, reason))
+        self.code = code
+        self.reason = reason
+
+
+class CircuitOpenError(CrowdAPIError):
+    """Raised instead of sending a request while the circuit breaker is open."""
+
+    def __init__(self, retry_in):
+        reason = "circuit breaker open, retry in {:.1f}s".format(retry_in)
+        Exception.__init__(self, reason)
+        self.code = None
+        self.reason = reason
+        self.retry_in = retry_in
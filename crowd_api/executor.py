@@ -0,0 +1,34 @@
+#
+# executor.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def run_concurrently(fn, items, concurrency=8):
+    """Call fn on every item from a bounded thread pool, yielding (item, result) pairs as they complete.
+
+    Items are pulled lazily from the iterable, so at most a couple of batches
+    of work are pending at any time regardless of the input size.
+    """
+    items = iter(items)
+    max_pending = concurrency * 2
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+
+        for item in items:
+            pending[executor.submit(fn, item)] = item
+            if len(pending) < max_pending:
+                continue
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
@@ -0,0 +1,157 @@
+#
+# graph.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+from collections import deque
+
+
+class GroupGraph:
+    """In-memory snapshot of the group hierarchy and direct memberships.
+
+    The snapshot is built from the direct-membership endpoints only; nested
+    membership, ancestor and descendant queries are then answered locally
+    from precomputed transitive closures.
+    """
+
+    def __init__(self, crowd, groups=None, page_size=1000):
+        self.crowd = crowd
+        self.page_size = page_size
+
+        self.children = {}
+        self.parents = {}
+        self.members = {}
+        self.user_groups = {}
+
+        self._loaded = set()
+        self._ancestors = {}
+        self._descendants = {}
+        self._nested_user_groups = {}
+        self._nested_group_users = {}
+
+        if groups is None:
+            groups = crowd.iter_all_groups(page_size=page_size)
+
+        self._load(groups)
+
+        for groupname in self.members:
+            self._ancestors[groupname] = self._closure(groupname, self.parents)
+            self._descendants[groupname] = self._closure(groupname, self.children)
+
+    def _node(self, groupname):
+        self.children.setdefault(groupname, set())
+        self.parents.setdefault(groupname, set())
+        self.members.setdefault(groupname, set())
+
+    def _load(self, groups):
+        queue = deque(groups)
+        while queue:
+            groupname = queue.popleft()
+            if groupname in self._loaded:
+                continue
+            self._load_group(groupname)
+            # children hidden from the group listing still belong in the graph
+            queue.extend(g for g in self.children[groupname] if g not in self._loaded)
+
+    def _load_group(self, groupname):
+        self._node(groupname)
+        self._loaded.add(groupname)
+
+        for child in self.crowd.iter_direct_children_of_group(groupname, page_size=self.page_size):
+            self._node(child)
+            self.children[groupname].add(child)
+            self.parents[child].add(groupname)
+
+        for username in self.crowd.iter_group_users(groupname, page_size=self.page_size):
+            self.members[groupname].add(username)
+            self.user_groups.setdefault(username, set()).add(groupname)
+
+    @staticmethod
+    def _closure(groupname, edges):
+        seen = set()
+        queue = deque(edges.get(groupname, ()))
+        while queue:
+            node = queue.popleft()
+            if node not in seen:
+                seen.add(node)
+                queue.extend(edges.get(node, ()))
+        seen.discard(groupname)
+        return frozenset(seen)
+
+    def refresh_group(self, groupname):
+        """Reload the direct children, parents and members of a single group."""
+        affected = {groupname}
+        affected |= self._ancestors.get(groupname, frozenset())
+        affected |= self._descendants.get(groupname, frozenset())
+
+        loaded = set(self._loaded)
+        self._node(groupname)
+
+        for child in self.children[groupname]:
+            self.parents[child].discard(groupname)
+        for parent in self.parents[groupname]:
+            self.children[parent].discard(groupname)
+        for username in self.members[groupname]:
+            self.user_groups[username].discard(groupname)
+
+        self.children[groupname] = set()
+        self.parents[groupname] = set()
+        self.members[groupname] = set()
+
+        self._loaded.discard(groupname)
+        self._load([groupname])
+
+        res = self.crowd.get_parent_groupsv2(groupname=groupname)
+        for parent in res.get('groups', []):
+            self._node(parent)
+            self.parents[groupname].add(parent)
+            self.children[parent].add(groupname)
+        self._load(res.get('groups', []))
+
+        affected.add(groupname)
+        affected |= self._closure(groupname, self.parents)
+        affected |= self._closure(groupname, self.children)
+        # new parents bring in their other children, whose closures are not known yet
+        for node in self._loaded - loaded:
+            affected.add(node)
+            affected |= self._closure(node, self.children)
+
+        for node in affected:
+            self._ancestors[node] = self._closure(node, self.parents)
+            self._descendants[node] = self._closure(node, self.children)
+
+        self._nested_user_groups.clear()
+        self._nested_group_users.clear()
+
+    def ancestors(self, groupname):
+        """Groups the given group is a nested member of."""
+        return self._ancestors.get(groupname, frozenset())
+
+    def descendants(self, groupname):
+        """Groups nested, at any depth, under the given group."""
+        return self._descendants.get(groupname, frozenset())
+
+    def nested_user_groups(self, username):
+        groups = self._nested_user_groups.get(username)
+        if groups is None:
+            groups = set()
+            for groupname in self.user_groups.get(username, ()):
+                groups.add(groupname)
+                groups |= self._ancestors[groupname]
+            groups = self._nested_user_groups[username] = frozenset(groups)
+        return groups
+
+    def nested_group_users(self, groupname):
+        users = self._nested_group_users.get(groupname)
+        if users is None:
+            users = set(self.members.get(groupname, ()))
+            for child in self.descendants(groupname):
+                users |= self.members[child]
+            users = self._nested_group_users[groupname] = frozenset(users)
+        return users
+
+    def is_member(self, username, groupname, nested=True):
+        if nested:
+            return groupname in self.nested_user_groups(username)
+        return groupname in self.user_groups.get(username, ())
@@ -0,0 +1,165 @@
+#
+# instrumentation.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import bisect
+import threading
+import time
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class RequestEvent:
+    """What is known about a single API request, passed to the hooks and exporters."""
+
+    __slots__ = ("method", "endpoint", "query", "status", "bytes", "retries", "elapsed", "error", "started")
+
+    def __init__(self, method, query):
+        self.method = method
+        self.query = query
+        # the endpoint template is the path without its query string, e.g. /user/group/direct;
+        # paths holding a token are passed in as their template, e.g. /session/{token}
+        self.endpoint = query.split('?', 1)[0]
+        self.status = None
+        self.bytes = None
+        self.retries = 0
+        self.elapsed = None
+        self.error = None
+        self.started = time.perf_counter()
+
+
+class LatencyHistogram:
+    """Bucketed latency histogram; percentiles are interpolated within the matching bucket."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return None
+
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def summary(self):
+        return {"count": self.count, "errors": self.errors, "sum": self.sum,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99)}
+
+
+class Exporter:
+    """Base class for metrics/tracing exporters; start() runs before a request, finish() after it."""
+
+    def start(self, event):
+        pass
+
+    def finish(self, event):
+        pass
+
+
+class PrometheusExporter(Exporter):
+    """Render the instrumentation histograms in the Prometheus text exposition format."""
+
+    def __init__(self, instrumentation, prefix="crowd_api"):
+        self.instrumentation = instrumentation
+        self.prefix = prefix
+
+    def render(self):
+        name = self.prefix + "_request_duration_seconds"
+        lines = ["# TYPE {} histogram".format(name)]
+
+        for (method, endpoint), hist in sorted(self.instrumentation.histograms().items()):
+            labels = 'method="{}",endpoint="{}"'.format(method, endpoint)
+            cumulative = 0
+            for bound, count in zip(hist.buckets, hist.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, hist.count))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, hist.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, hist.count))
+
+        lines.append("# TYPE {}_request_errors_total counter".format(self.prefix))
+        for (method, endpoint), hist in sorted(self.instrumentation.histograms().items()):
+            lines.append('{}_request_errors_total{{method="{}",endpoint="{}"}} {}'.format(
+                self.prefix, method, endpoint, hist.errors))
+
+        return "\n".join(lines) + "\n"
+
+
+class Instrumentation:
+    """Before/after request hooks plus per-endpoint latency histograms.
+
+    A request counts as an error when it raised or got a 5xx/429 response.
+    """
+
+    def __init__(self):
+        self.before_hooks = []
+        self.after_hooks = []
+        self.exporters = []
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def add_before_hook(self, hook):
+        self.before_hooks.append(hook)
+
+    def add_after_hook(self, hook):
+        self.after_hooks.append(hook)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def before(self, event):
+        for hook in self.before_hooks:
+            hook(event)
+        for exporter in self.exporters:
+            exporter.start(event)
+
+    def after(self, event):
+        event.elapsed = time.perf_counter() - event.started
+        error = event.error is not None or event.status == 429 or (event.status or 0) >= 500
+
+        key = (event.method, event.endpoint)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = LatencyHistogram()
+            hist.observe(event.elapsed, error)
+
+        for hook in self.after_hooks:
+            hook(event)
+        for exporter in self.exporters:
+            exporter.finish(event)
+
+    def histograms(self):
+        with self._lock:
+            return dict(self._histograms)
+
+    def stats(self):
+        """Per-endpoint count, error count and p50/p95/p99 latency in seconds, keyed on "METHOD /endpoint"."""
+        with self._lock:
+            return {"{} {}".format(method, endpoint): hist.summary()
+                    for (method, endpoint), hist in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
@@ -0,0 +1,193 @@
+#
+# membership.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import hashlib
+import math
+import threading
+import time
+
+from .exceptions import CrowdAPIError
+from .executor import run_concurrently
+
+# Crowd answers 409 when adding an existing membership and 404 when removing a missing one
+MEMBERSHIP_EXISTS = 409
+MEMBERSHIP_NOT_FOUND = 404
+
+
+def mutate(crowd, action, groupname, username):
+    """Add or remove one direct membership, returning "done", "unchanged" or the failed request."""
+    if action == "add":
+        req = crowd.add_user_to_group(username=username, groupname=groupname)
+        noop = MEMBERSHIP_EXISTS
+    else:
+        req = crowd.remove_user_from_group(username=username, groupname=groupname)
+        noop = MEMBERSHIP_NOT_FOUND
+
+    if req['status']:
+        return "done"
+    if req['code'] == noop:
+        return "unchanged"
+    return req
+
+
+def _unique(names):
+    seen = set()
+    return [n for n in names if not (n in seen or seen.add(n))]
+
+
+def _bulk(crowd, ops, concurrency):
+    """Run (action, groupname, username) operations concurrently and sort the outcomes per action."""
+    result = {"status": True, "added": [], "removed": [], "unchanged": [], "errors": []}
+    outcomes = dict(run_concurrently(lambda op: mutate(crowd, *op), ops, concurrency))
+
+    # report in input order, whatever order the requests completed in
+    for op in ops:
+        action, groupname, username = op
+        outcome = outcomes[op]
+        if outcome == "done":
+            result["added" if action == "add" else "removed"].append(username)
+        elif outcome == "unchanged":
+            result['unchanged'].append(username)
+        else:
+            result['status'] = False
+            result['errors'].append({"op": action, "group": groupname, "user": username,
+                                     "code": outcome['code'], "reason": outcome['reason']})
+
+    return result
+
+
+def add_users_to_group(crowd, groupname, usernames, concurrency=8):
+    """Add many users to a group; users already in it are reported as unchanged."""
+    return _bulk(crowd, [("add", groupname, u) for u in _unique(usernames)], concurrency)
+
+
+def remove_users_from_group(crowd, groupname, usernames, concurrency=8):
+    """Remove many users from a group; users not in it are reported as unchanged."""
+    return _bulk(crowd, [("remove", groupname, u) for u in _unique(usernames)], concurrency)
+
+
+def set_group_members(crowd, groupname, usernames, concurrency=8, page_size=1000):
+    """Make the direct members of a group exactly `usernames`, only sending the adds and removes needed."""
+    wanted = _unique(usernames)
+    # names are case-insensitive in Crowd
+    try:
+        current = {u.lower(): u for u in crowd.iter_group_users(groupname, page_size=page_size)}
+    except CrowdAPIError as e:
+        return {"status": False, "code": e.code, "reason": e.reason}
+    wanted_keys = set(u.lower() for u in wanted)
+
+    ops = [("add", groupname, u) for u in wanted if u.lower() not in current] + \
+          [("remove", groupname, u) for key, u in sorted(current.items()) if key not in wanted_keys]
+    result = _bulk(crowd, ops, concurrency)
+    result['unchanged'] += [u for u in wanted if u.lower() in current]
+    return result
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings: no false negatives, about `error_rate` false positives."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing: two 64-bit halves of one digest stand in for k hash functions
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class MembershipIndex:
+    """Local per-group member sets answering membership checks without a request.
+
+    Each group's (direct or nested) members are loaded with paged listings
+    the first time the group is checked and reloaded after `ttl` seconds.
+    Only the groups in `groups` are indexed when given. With `bloom`, a
+    Bloom filter replaces each set: a miss is still a definite "no", but a
+    hit is only probable and is confirmed with the server.
+    """
+
+    def __init__(self, crowd, groups=None, ttl=300, bloom=False, error_rate=0.01, page_size=1000):
+        self.crowd = crowd
+        self.groups = None if groups is None else set(g.lower() for g in groups)
+        self.ttl = ttl
+        self.bloom = bloom
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def _load(self, groupname, nested):
+        if nested:
+            names = list(self.crowd.iter_nested_group_users(groupname, page_size=self.page_size))
+        else:
+            names = list(self.crowd.iter_group_users(groupname, page_size=self.page_size))
+
+        if not self.bloom:
+            return set(n.lower() for n in names)
+        members = BloomFilter(len(names), self.error_rate)
+        for name in names:
+            members.add(name.lower())
+        return members
+
+    def check(self, username, groupname, nested=False):
+        """True or False when the index can tell, None when the server has to be asked."""
+        if self.groups is not None and groupname.lower() not in self.groups:
+            return None
+
+        key = (groupname.lower(), nested)
+        with self._lock:
+            entry = self._members.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            try:
+                members = self._load(groupname, nested)
+            except CrowdAPIError:
+                return None
+            entry = (time.monotonic() + self.ttl, members)
+            with self._lock:
+                self._members[key] = entry
+
+        if username.lower() not in entry[1]:
+            return False
+        return None if self.bloom else True
+
+    def added(self, username, groupname):
+        """Record a direct membership added through the client."""
+        with self._lock:
+            entry = self._members.get((groupname.lower(), False))
+            if entry is not None:
+                entry[1].add(username.lower())
+            # nested sets of every ancestor may change, and Bloom filters can't be updated in place
+            for key in [k for k in self._members if k[1]]:
+                del self._members[key]
+
+    def removed(self, username, groupname):
+        """Record a direct membership removed through the client."""
+        with self._lock:
+            entry = self._members.get((groupname.lower(), False))
+            if entry is not None and not self.bloom:
+                entry[1].discard(username.lower())
+            elif entry is not None:
+                del self._members[(groupname.lower(), False)]
+            for key in [k for k in self._members if k[1]]:
+                del self._members[key]
+
+    def invalidate(self, groupname=None):
+        with self._lock:
+            if groupname is None:
+                self._members.clear()
+            else:
+                for nested in (False, True):
+                    self._members.pop((groupname.lower(), nested), None)
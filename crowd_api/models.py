@@ -0,0 +1,106 @@
+#
+# models.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import sys
+
+
+def _raw_attributes(doc):
+    # expanded attributes come wrapped as {"link": ..., "attributes": [...]}
+    attributes = doc.get('attributes')
+    if isinstance(attributes, dict):
+        return attributes.get('attributes')
+    return attributes
+
+
+class Attribute:
+    __slots__ = ("name", "values")
+
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+    def __repr__(self):
+        return "Attribute({!r}, {!r})".format(self.name, self.values)
+
+    @property
+    def value(self):
+        """The first value, for the common single-valued attributes."""
+        return self.values[0] if self.values else None
+
+
+class _Entity:
+    """Shared behaviour of the compact entity models: lazily decoded attributes and JSON round-tripping.
+
+    Entities fetched without their attributes can be given a loader, called
+    to fetch the raw attribute list the first time `attributes` is read.
+    """
+
+    __slots__ = ("name", "active", "_raw_attributes", "_attributes", "_loader")
+
+    # JSON key -> slot name, defined by the subclasses
+    FIELDS = {}
+
+    def __init__(self, name, active=True, attributes=None, loader=None, **fields):
+        self.name = sys.intern(name)
+        self.active = active
+        self._raw_attributes = attributes
+        self._attributes = None
+        self._loader = loader
+        for slot in self.FIELDS.values():
+            setattr(self, slot, fields.get(slot))
+
+    @classmethod
+    def from_json(cls, doc, loader=None):
+        fields = {slot: doc.get(key) for key, slot in cls.FIELDS.items()}
+        return cls(doc['name'], doc.get('active', True), _raw_attributes(doc), loader, **fields)
+
+    def to_json(self):
+        doc = {"name": self.name, "active": self.active}
+        for key, slot in self.FIELDS.items():
+            value = getattr(self, slot)
+            if value is not None:
+                doc[key] = value
+        if self.attributes_loaded:
+            doc['attributes'] = {"attributes": [{"name": a.name, "values": a.values}
+                                                for a in self.attributes.values()]}
+        return doc
+
+    @property
+    def attributes_loaded(self):
+        return self._attributes is not None or self._raw_attributes is not None
+
+    @property
+    def attributes(self):
+        """Attributes keyed on name, decoded from the raw payload on first access."""
+        if self._attributes is None:
+            if self._raw_attributes is None and self._loader is not None:
+                self._raw_attributes = self._loader()
+            self._loader = None
+            self._attributes = {a['name']: Attribute(a['name'], a.get('values', []))
+                                for a in self._raw_attributes or []}
+            self._raw_attributes = None
+        return self._attributes
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_json() == other.to_json()
+
+    __hash__ = None
+
+
+class User(_Entity):
+    __slots__ = ("first_name", "last_name", "display_name", "email", "key")
+
+    FIELDS = {"first-name": "first_name", "last-name": "last_name", "display-name": "display_name",
+              "email": "email", "key": "key"}
+
+
+class Group(_Entity):
+    __slots__ = ("description", "type")
+
+    FIELDS = {"description": "description", "type": "type"}
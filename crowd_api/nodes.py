@@ -0,0 +1,197 @@
+#
+# nodes.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import threading
+import time
+import weakref
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+# gateway answers of a node that is down or overloaded, worth trying elsewhere
+FAILOVER_STATUSES = (502, 503, 504)
+
+
+def _not_sent(exc):
+    """Whether a connection error happened before the request reached the server."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _probe_loop(pool_ref, stop, interval):
+    # only a weak reference, so a pool (and the client owning it) that is
+    # never closed can still be collected, which ends the thread
+    while not stop.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
+        pool._probe()
+        del pool
+
+
+class Node:
+    __slots__ = ("url", "outstanding", "latency", "failures", "ejected_until")
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self):
+        return "Node({!r})".format(self.url)
+
+
+class NodePool:
+    """Spread requests over the nodes of a Crowd cluster and fail over between them.
+
+    Reads go to the available node with the fewest requests in flight
+    ("least_outstanding", ties broken by latency) or with the lowest
+    latency weighted by its load ("latency"). Writes stick to the first
+    available node in configuration order. Nodes are ejected for
+    `eject_time` seconds after `failure_threshold` consecutive failures, or
+    as soon as their average latency exceeds `slow_threshold`. When
+    `probe_interval` is set, a background thread checks every node with
+    `probe(url)` and brings recovered ones back early.
+    """
+
+    def __init__(self, urls, strategy="least_outstanding", failure_threshold=3, eject_time=30, slow_threshold=None,
+                 probe=None, probe_interval=10):
+        if strategy not in ("least_outstanding", "latency"):
+            raise ValueError("Unknown node selection strategy " + strategy)
+
+        self.nodes = [Node(url) for url in urls]
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.eject_time = eject_time
+        self.slow_threshold = slow_threshold
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        if probe is not None and probe_interval:
+            self._thread = threading.Thread(target=_probe_loop, args=(weakref.ref(self), self._stop, probe_interval),
+                                            name="crowd-node-probe", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _rank(self, node):
+        latency = node.latency if node.latency is not None else 0.0
+        if self.strategy == "latency":
+            return (latency * (node.outstanding + 1), node.outstanding)
+        return (node.outstanding, latency)
+
+    def select(self, exclude=(), write=False):
+        """Pick a node for the next request, or None once every node has been tried."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [n for n in self.nodes if n not in exclude]
+            if not candidates:
+                return None
+
+            available = [n for n in candidates if n.ejected_until <= now]
+            if not available:
+                # everything is ejected: the node closest to coming back is the best bet
+                node = min(candidates, key=lambda n: n.ejected_until)
+            elif write:
+                node = available[0]
+            else:
+                node = min(available, key=self._rank)
+
+            node.outstanding += 1
+            return node
+
+    def _release(self, node, elapsed=None, failed=False):
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                if node.failures >= self.failure_threshold:
+                    node.ejected_until = time.monotonic() + self.eject_time
+                return
+
+            node.failures = 0
+            if elapsed is not None:
+                # exponentially weighted moving average
+                node.latency = elapsed if node.latency is None else 0.8 * node.latency + 0.2 * elapsed
+                if self.slow_threshold is not None and node.latency > self.slow_threshold:
+                    node.ejected_until = time.monotonic() + self.eject_time
+
+    def send(self, request, idempotent=True, write=False):
+        """Call request(base_url) on a node, moving on to the next one when it is down.
+
+        Requests that are not idempotent only fail over when they provably
+        never reached the failed node.
+        """
+        tried = []
+        error = None
+
+        while True:
+            node = self.select(tried, write)
+            if node is None:
+                raise error
+            tried.append(node)
+
+            start = time.monotonic()
+            try:
+                resp = request(node.url)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._release(node, failed=True)
+                if not idempotent and not _not_sent(e):
+                    raise
+                error = e
+                continue
+            except Exception:
+                with self._lock:
+                    node.outstanding -= 1
+                raise
+
+            if resp.status_code in FAILOVER_STATUSES:
+                self._release(node, failed=True)
+                if len(tried) < len(self.nodes) and (idempotent or resp.status_code == 503):
+                    continue
+                return resp
+
+            self._release(node, time.monotonic() - start)
+            return resp
+
+    def _probe(self):
+        for node in self.nodes:
+            start = time.monotonic()
+            try:
+                healthy = self.probe(node.url)
+            except Exception:
+                healthy = False
+            elapsed = time.monotonic() - start
+            if self.slow_threshold is not None and elapsed > self.slow_threshold:
+                healthy = False
+
+            with self._lock:
+                if healthy:
+                    if node.ejected_until:
+                        # forget the latency that got it ejected
+                        node.latency = None
+                    node.failures = 0
+                    node.ejected_until = 0.0
+                else:
+                    node.failures = max(node.failures, self.failure_threshold)
+                    node.ejected_until = time.monotonic() + self.eject_time
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{"url": n.url, "outstanding": n.outstanding, "latency": n.latency, "failures": n.failures,
+                     "ejected": n.ejected_until > now} for n in self.nodes]
@@ -0,0 +1,224 @@
+#
+# offline.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import argparse
+import json
+import sys
+
+from .restriction import FIELDS, UnsupportedRestriction, check_fields, parse
+from .store import SnapshotStore
+from .sync import DirectorySync
+
+DESCENDANTS = """
+WITH RECURSIVE descendants(name) AS (
+    SELECT child FROM group_children WHERE parent = ?
+    UNION SELECT gc.child FROM group_children gc JOIN descendants d ON gc.parent = d.name
+)"""
+
+ANCESTORS = """
+WITH RECURSIVE ancestors(name) AS (
+    SELECT parent FROM group_children WHERE child = ?
+    UNION SELECT gc.parent FROM group_children gc JOIN ancestors a ON gc.child = a.name
+)"""
+
+USER_ANCESTORS = """
+WITH RECURSIVE ancestors(name) AS (
+    SELECT groupname FROM memberships WHERE username = ?
+    UNION SELECT gc.parent FROM group_children gc JOIN ancestors a ON gc.child = a.name
+)"""
+
+
+def export_snapshot(crowd, path, page_size=1000, concurrency=8):
+    """Dump users, groups, attributes, memberships and group nesting into an SQLite snapshot.
+
+    Exporting into an existing snapshot only applies what changed since.
+    """
+    store = SnapshotStore(path)
+    try:
+        return DirectorySync(crowd, store, page_size=page_size, concurrency=concurrency).sync()
+    finally:
+        store.close()
+
+
+class OfflineCrowdAPI:
+    """Read-only, CrowdAPI-compatible facade answering lookups from a snapshot made by export_snapshot."""
+
+    def __init__(self, path):
+        self.store = SnapshotStore(path, readonly=True)
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _rows(self, sql, params, **kwargs):
+        sql += " LIMIT ? OFFSET ?"
+        params = tuple(params) + (kwargs.get('max_results', 1000), kwargs.get('start_index', 0))
+        with self.store.lock:
+            return [row[0] for row in self.store.conn.execute(sql, params)]
+
+    def _exists(self, entity, name):
+        with self.store.lock:
+            return self.store.conn.execute(
+                "SELECT 1 FROM {}s WHERE name = ?".format(entity), (name,)).fetchone() is not None
+
+    def get_user(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        user = self.store.get("user", kwargs['username'])
+        if user is None:
+            return {"status": False, "user": None}
+        return {"status": True, "user": user}
+
+    def get_user_attributes(self, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+
+        user = self.store.get("user", kwargs['username'])
+        if user is None:
+            return {"status": False, "code": 404, "reason": b"USER_NOT_FOUND"}
+        return {"status": True, "Attributes": json.dumps(user.get('attributes', {"attributes": []})).encode()}
+
+    def get_group(self, **kwargs):
+        group = self.store.get("group", kwargs['name'])
+        if group is None:
+            return {"status": False, "code": 404, "reason": b"GROUP_NOT_FOUND"}
+        return {"status": True, "group": group}
+
+    def _user_listing(self, key, sql, **kwargs):
+        if "username" not in kwargs:
+            raise ValueError("Must pass username")
+        if not self._exists("user", kwargs['username']):
+            return {"status": False, key: []}
+        return {"status": True, key: self._rows(sql, (kwargs['username'],), **kwargs)}
+
+    def _group_listing(self, key, sql, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+        if not self._exists("group", kwargs['groupname']):
+            return {"status": False, key: []}
+        return {"status": True, key: self._rows(sql, (kwargs['groupname'],), **kwargs)}
+
+    def get_user_groups(self, **kwargs):
+        return self._user_listing(
+            "groups", "SELECT groupname FROM memberships WHERE username = ? ORDER BY groupname", **kwargs)
+
+    def get_nested_user_groups(self, **kwargs):
+        return self._user_listing("groups", USER_ANCESTORS + " SELECT name FROM ancestors ORDER BY name", **kwargs)
+
+    def get_group_users(self, **kwargs):
+        return self._group_listing(
+            "users", "SELECT username FROM memberships WHERE groupname = ? ORDER BY username", **kwargs)
+
+    def get_nested_group_users(self, **kwargs):
+        if "groupname" not in kwargs:
+            raise ValueError("Must pass groupname")
+        if not self._exists("group", kwargs['groupname']):
+            return {"status": False, "users": []}
+        sql = DESCENDANTS + """ SELECT DISTINCT username FROM memberships
+            WHERE groupname = ? OR groupname IN (SELECT name FROM descendants) ORDER BY username"""
+        return {"status": True, "users": self._rows(sql, (kwargs['groupname'], kwargs['groupname']), **kwargs)}
+
+    def get_parent_groups(self, **kwargs):
+        res = self.get_parent_groupsv2(**kwargs)
+        return {"status": res['status'], "pgroups": res['groups']}
+
+    def get_parent_groupsv2(self, **kwargs):
+        return self._group_listing(
+            "groups", "SELECT parent FROM group_children WHERE child = ? ORDER BY parent", **kwargs)
+
+    def get_nested_parent_groups(self, **kwargs):
+        return self._group_listing("groups", ANCESTORS + " SELECT name FROM ancestors ORDER BY name", **kwargs)
+
+    def get_direct_children_of_group(self, **kwargs):
+        return self._group_listing(
+            "groups", "SELECT child FROM group_children WHERE parent = ? ORDER BY child", **kwargs)
+
+    def get_nested_children_of_group(self, **kwargs):
+        return self._group_listing("groups", DESCENDANTS + " SELECT name FROM descendants ORDER BY name", **kwargs)
+
+    def get_all_users(self, **kwargs):
+        return {"status": True, "users": self._rows("SELECT name FROM users ORDER BY name", (), **kwargs)}
+
+    def get_all_groups(self, **kwargs):
+        return {"status": True, "groups": self._rows("SELECT name FROM groups ORDER BY name", (), **kwargs)}
+
+    def _term_sql(self, entity, field, value, prefix):
+        op, value = ("LIKE", value.replace('%', r'\%').replace('_', r'\_') + '%') if prefix else ("=", value)
+        escape = " ESCAPE '\\'" if op == "LIKE" else ""
+        table = entity + "s"
+
+        if field == "name" or (field == "email" and entity == "user"):
+            sql = "SELECT name FROM {} WHERE {} {} ?{}".format(table, field, op, escape)
+        elif field in FIELDS[entity]:
+            sql = "SELECT name FROM {} WHERE json_extract(doc, '$.\"{}\"') {} ? COLLATE NOCASE{}".format(
+                table, FIELDS[entity][field], op, escape)
+            if field == "active":
+                value = 1 if value.lower() == "true" else 0
+        else:
+            sql = "SELECT name FROM attributes WHERE entity = '{}' AND attribute = '{}' AND value {} ?{}".format(
+                entity, field.replace("'", "''"), op, escape)
+
+        return sql, [value]
+
+    def _compile(self, entity, tree):
+        if tree[0] == "term":
+            return self._term_sql(entity, *tree[1:])
+
+        parts, params = [], []
+        for node in tree[1]:
+            sql, args = self._compile(entity, node)
+            parts.append("SELECT name FROM ({})".format(sql))
+            params += args
+        return (" INTERSECT " if tree[0] == "and" else " UNION ").join(parts), params
+
+    def _search(self, entity, **kwargs):
+        if 'restriction' not in kwargs:
+            raise ValueError("You need to define a certain restriction")
+
+        sql, params = self._compile(entity, check_fields(parse(kwargs['restriction']), entity))
+        return self._rows("SELECT DISTINCT name FROM ({}) ORDER BY name".format(sql), params, **kwargs)
+
+    def search_user(self, **kwargs):
+        try:
+            return {"status": True, "users": self._search("user", **kwargs)}
+        except UnsupportedRestriction as e:
+            return {"status": False, "code": 400, "reason": str(e).encode()}
+
+    def search_group(self, **kwargs):
+        try:
+            return {"status": True, "groups": self._search("group", **kwargs)}
+        except UnsupportedRestriction as e:
+            return {"status": False, "code": 400, "reason": str(e).encode()}
+
+
+def main():
+    from . import CrowdAPI
+
+    parser = argparse.ArgumentParser(description='Export the Crowd directory into an offline SQLite snapshot')
+    parser.add_argument("--api-url", action="store", dest="api_url", required=True, help="API URL")
+    parser.add_argument("--app-name", action="store", dest="app_name", required=True, help="Application name")
+    parser.add_argument("--app-password", action="store", dest="app_password", required=True, help="Application password")
+    parser.add_argument("--no-ssl-verify", action="store_false", dest="verify_ssl", help="Disable SSL verification")
+    parser.add_argument("--page-size", type=int, default=1000, dest="page_size", help="Page size (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent listing calls (default: %(default)s)")
+    parser.add_argument("snapshot", help="SQLite snapshot file to create or update")
+    opts = parser.parse_args()
+
+    with CrowdAPI(api_url=opts.api_url, app_name=opts.app_name, app_password=opts.app_password,
+                  verify_ssl=opts.verify_ssl, pool_maxsize=max(10, opts.concurrency)) as crowd:
+        events = export_snapshot(crowd, opts.snapshot, page_size=opts.page_size, concurrency=opts.concurrency)
+
+    print("{}: {} changes exported".format(opts.snapshot, len(events)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#
+# provision.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+from .exceptions import CrowdAPIError
+from .executor import run_concurrently
+from .membership import MEMBERSHIP_EXISTS
+
+
+def provision_user(crowd, user):
+    """Bring a single user in line with its definition, creating it and adding missing memberships.
+
+    The user definition uses the same keys as examples/users.json (name,
+    first-name, last-name, display-name, email, groups and an optional
+    password). Only the operations needed to reach that state are run, so
+    provisioning the same user twice is a no-op.
+    """
+    result = {"name": user['name'], "status": True, "created": False, "groups_added": [], "errors": []}
+
+    req = crowd.get_user(username=user['name'])
+    if not req['status'] and 'code' in req:
+        result['status'] = False
+        result['errors'].append({"op": "get_user", "code": req['code'], "reason": req['reason']})
+        return result
+
+    if req['status']:
+        try:
+            current = set(crowd.iter_user_groups(user['name']))
+        except CrowdAPIError as e:
+            result['status'] = False
+            result['errors'].append({"op": "get_user_groups", "code": e.code, "reason": e.reason})
+            return result
+    else:
+        attributes = {k.replace('-', '_'): v for k, v in user.items() if k != 'groups'}
+        create_req = crowd.create_user(**attributes)
+        if not create_req['status']:
+            result['status'] = False
+            result['errors'].append({"op": "create_user", "code": create_req['code'], "reason": create_req['reason']})
+            return result
+
+        result['created'] = True
+        if 'password' in create_req:
+            result['password'] = create_req['password']
+        current = set()
+
+    for groupname in user.get('groups', []):
+        if groupname in current:
+            continue
+
+        group_req = crowd.add_user_to_group(username=user['name'], groupname=groupname)
+        if group_req['status']:
+            result['groups_added'].append(groupname)
+        elif group_req['code'] != MEMBERSHIP_EXISTS:
+            result['status'] = False
+            result['errors'].append({"op": "add_user_to_group", "group": groupname,
+                                     "code": group_req['code'], "reason": group_req['reason']})
+
+    return result
+
+
+def try_provision_user(crowd, user):
+    """Like provision_user, but an exception is reported as a failed result instead of being raised."""
+    try:
+        return provision_user(crowd, user)
+    except Exception as e:
+        return {"name": user['name'], "status": False, "created": False, "groups_added": [],
+                "errors": [{"op": "provision_user", "code": getattr(e, 'code', None), "reason": str(e)}]}
+
+
+def bulk_provision(crowd, users, concurrency=8):
+    """Provision many users concurrently, returning the per-user results in input order.
+
+    Later definitions of a name already seen (case-insensitively) are ignored.
+    """
+    # names are case-insensitive in Crowd, two definitions of one user would race
+    unique = {}
+    for user in users:
+        unique.setdefault(user['name'].lower(), user)
+    users = list(unique.values())
+    results = {}
+
+    for user, result in run_concurrently(lambda u: try_provision_user(crowd, u), users, concurrency):
+        results[user['name'].lower()] = result
+
+    return {"status": all(r['status'] for r in results.values()),
+            "results": [results[user['name'].lower()] for user in users]}
@@ -0,0 +1,103 @@
+#
+# reconcile.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import json
+
+from .exceptions import CrowdAPIError
+from .executor import run_concurrently
+from .membership import mutate
+
+
+def load_desired(path):
+    """Load a desired-state file mapping each group name to the list of its direct members."""
+    with open(path, 'r') as fd:
+        return {groupname: set(users) for groupname, users in json.load(fd).items()}
+
+
+class MembershipPlan:
+    """The minimal set of membership changes needed to reach the desired state."""
+
+    def __init__(self, adds, removes):
+        self.adds = adds
+        self.removes = removes
+
+    def __len__(self):
+        return len(self.adds) + len(self.removes)
+
+    def format(self):
+        lines = ["+ {} -> {}".format(username, groupname) for groupname, username in self.adds]
+        lines += ["- {} -> {}".format(username, groupname) for groupname, username in self.removes]
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {"add": [{"group": g, "user": u} for g, u in self.adds],
+                "remove": [{"group": g, "user": u} for g, u in self.removes]}
+
+
+class MembershipReconciler:
+    """Sync direct group memberships against a desired {group: users} map.
+
+    The current state is read with one paged listing per managed group and
+    diffed locally, so an already in-sync directory only costs the listing
+    calls. Groups missing from the desired map are left untouched.
+    """
+
+    def __init__(self, crowd, page_size=1000, concurrency=8):
+        self.crowd = crowd
+        self.page_size = page_size
+        self.concurrency = concurrency
+
+    def load_current(self, groups):
+        current = {}
+        for groupname, users in run_concurrently(
+                lambda g: set(self.crowd.iter_group_users(g, page_size=self.page_size)), groups, self.concurrency):
+            current[groupname] = users
+        return current
+
+    def plan(self, desired, current=None, remove=True):
+        if current is None:
+            current = self.load_current(desired)
+
+        # names are case-insensitive in Crowd; removes use the server's spelling
+        current = {g.lower(): users for g, users in current.items()}
+
+        adds = []
+        removes = []
+        for groupname in sorted(desired):
+            wanted = {u.lower(): u for u in desired[groupname]}
+            existing = {u.lower(): u for u in current.get(groupname.lower(), ())}
+            adds += [(groupname, wanted[key]) for key in sorted(wanted.keys() - existing.keys())]
+            if remove:
+                removes += [(groupname, existing[key]) for key in sorted(existing.keys() - wanted.keys())]
+
+        return MembershipPlan(adds, removes)
+
+    def apply(self, plan, dry_run=False):
+        if dry_run:
+            return {"status": True, "dry_run": True, "plan": plan.to_dict()}
+
+        ops = [("add", g, u) for g, u in plan.adds] + [("remove", g, u) for g, u in plan.removes]
+        added = removed = 0
+        errors = []
+
+        for (action, groupname, username), outcome in run_concurrently(
+                lambda op: mutate(self.crowd, *op), ops, self.concurrency):
+            if isinstance(outcome, dict):
+                errors.append({"op": action, "group": groupname, "user": username,
+                               "code": outcome['code'], "reason": outcome['reason']})
+            elif action == "add":
+                added += 1
+            else:
+                removed += 1
+
+        return {"status": not errors, "added": added, "removed": removed, "errors": errors}
+
+    def sync(self, desired, dry_run=False, remove=True):
+        try:
+            plan = self.plan(desired, remove=remove)
+        except CrowdAPIError as e:
+            return {"status": False, "code": e.code, "reason": e.reason}
+        return self.apply(plan, dry_run=dry_run)
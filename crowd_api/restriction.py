@@ -0,0 +1,318 @@
+#
+# restriction.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import bisect
+import re
+import threading
+import time
+
+TOKEN = re.compile(r'\s*(?:(\()|(\))|(=)|"((?:[^"\\]|\\.)*)"|([^\s()="]+))')
+
+# CQL names of the entity fields matched directly, with their keys in the REST
+# documents; any other field name is an attribute
+FIELDS = {"user": {"name": "name", "email": "email", "active": "active", "firstName": "first-name",
+                   "lastName": "last-name", "displayName": "display-name"},
+          "group": {"name": "name", "active": "active", "description": "description"}}
+
+# built-in fields missing from the listed documents, only the server can match on them
+UNSUPPORTED_FIELDS = {"user": ("createdDate", "updatedDate", "externalId"),
+                      "group": ("createdDate", "updatedDate", "type")}
+
+
+class UnsupportedRestriction(ValueError):
+    """The restriction uses syntax the local evaluator does not handle; ask the server instead."""
+
+
+def parse(restriction):
+    """Parse the supported CQL subset into a tree of ("term", field, value, prefix), ("and", [...]) and ("or", [...]).
+
+    Supported: `field = value` terms with quoted or bare values, a trailing
+    `*` for prefix matches, AND/OR (AND binding tighter) and parentheses.
+    """
+    tokens = []
+    pos = 0
+    restriction = restriction.strip()
+    while pos < len(restriction):
+        m = TOKEN.match(restriction, pos)
+        if m is None or m.end() == pos:
+            raise UnsupportedRestriction("Cannot parse restriction: " + restriction)
+        lparen, rparen, eq, quoted, bare = m.groups()
+        if lparen:
+            tokens.append(("(", None))
+        elif rparen:
+            tokens.append((")", None))
+        elif eq:
+            tokens.append(("=", None))
+        elif quoted is not None:
+            tokens.append(("str", re.sub(r'\\(.)', r'\1', quoted)))
+        elif bare.lower() in ("and", "or"):
+            tokens.append((bare.lower(), None))
+        else:
+            tokens.append(("str", bare))
+        pos = m.end()
+
+    def expect(i, kind):
+        if i >= len(tokens) or tokens[i][0] != kind:
+            raise UnsupportedRestriction("Cannot parse restriction: " + restriction)
+        return i + 1
+
+    def parse_or(i):
+        node, i = parse_and(i)
+        nodes = [node]
+        while i < len(tokens) and tokens[i][0] == "or":
+            node, i = parse_and(i + 1)
+            nodes.append(node)
+        return (nodes[0] if len(nodes) == 1 else ("or", nodes)), i
+
+    def parse_and(i):
+        node, i = parse_primary(i)
+        nodes = [node]
+        while i < len(tokens) and tokens[i][0] == "and":
+            node, i = parse_primary(i + 1)
+            nodes.append(node)
+        return (nodes[0] if len(nodes) == 1 else ("and", nodes)), i
+
+    def parse_primary(i):
+        if i < len(tokens) and tokens[i][0] == "(":
+            node, i = parse_or(i + 1)
+            return node, expect(i, ")")
+
+        field_index = i
+        i = expect(i, "str")
+        i = expect(i, "=")
+        value_index = i
+        i = expect(i, "str")
+        field, value = tokens[field_index][1], tokens[value_index][1]
+        if '*' in value[:-1]:
+            raise UnsupportedRestriction("Only trailing wildcards are supported: " + restriction)
+        if value.endswith('*'):
+            return ("term", field, value[:-1], True), i
+        return ("term", field, value, False), i
+
+    tree, i = parse_or(0)
+    if i != len(tokens):
+        raise UnsupportedRestriction("Cannot parse restriction: " + restriction)
+    return tree
+
+
+def check_fields(tree, entity_type):
+    """Raise UnsupportedRestriction if a parsed restriction uses a field only the server can match on."""
+    if tree[0] != "term":
+        for node in tree[1]:
+            check_fields(node, entity_type)
+    elif tree[1] in UNSUPPORTED_FIELDS[entity_type]:
+        raise UnsupportedRestriction("Cannot match {} locally".format(tree[1]))
+    return tree
+
+
+def _attributes(entity):
+    attributes = entity.get('attributes')
+    if isinstance(attributes, dict):
+        attributes = attributes.get('attributes')
+    return attributes or []
+
+
+class LocalSearchIndex:
+    """Hash and prefix indexes over a set of entity documents, answering parsed restrictions locally.
+
+    Matching is case-insensitive, like Crowd's. The index can be updated in
+    place as entities are written.
+    """
+
+    def __init__(self, entity_type, entities):
+        self.entity_type = entity_type
+        self.fields = FIELDS[entity_type]
+        self.exact = {}
+        self.sorted = None
+        # lowercased name -> (name, {(is attribute, field, lowercased value)})
+        self.entries = {}
+
+        for entity in entities:
+            self.put(entity)
+
+        self.sorted = {field: sorted(values) for field, values in self.exact.items()}
+
+    def _add(self, name, attribute, field, value):
+        value = str(value).lower()
+        values = self.exact.setdefault(field, {})
+        if value not in values:
+            values[value] = set()
+            if self.sorted is not None:
+                bisect.insort(self.sorted.setdefault(field, []), value)
+        values[value].add(name)
+        self.entries[name.lower()][1].add((attribute, field, value))
+
+    def _discard(self, name, attribute, field, value):
+        values = self.exact[field]
+        values[value].discard(name)
+        if not values[value]:
+            del values[value]
+            keys = self.sorted[field] if self.sorted is not None else []
+            i = bisect.bisect_left(keys, value)
+            if i < len(keys) and keys[i] == value:
+                del keys[i]
+        self.entries[name.lower()][1].discard((attribute, field, value))
+
+    def _drop(self, name, keep_attributes=False):
+        entry = self.entries.get(name.lower())
+        if entry is None:
+            return set()
+        kept = set(e for e in entry[1] if e[0] and keep_attributes)
+        for e in list(entry[1]):
+            self._discard(entry[0], *e)
+        del self.entries[name.lower()]
+        return kept
+
+    def put(self, entity):
+        """Index an entity, replacing what was indexed under its name; attributes are kept if it has none."""
+        name = entity['name']
+        kept = self._drop(name, keep_attributes=entity.get('attributes') is None)
+        self.entries[name.lower()] = (name, set())
+
+        for field, key in self.fields.items():
+            value = entity.get(key)
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            self._add(name, False, field, value)
+
+        for attribute in _attributes(entity):
+            for value in attribute.get('values', []):
+                self._add(name, True, attribute['name'], value)
+        for e in kept:
+            self._add(name, *e)
+
+    def set_attribute(self, name, attribute, values):
+        entry = self.entries.get(name.lower())
+        if entry is None:
+            return
+        for e in [e for e in entry[1] if e[0] and e[1] == attribute]:
+            self._discard(entry[0], *e)
+        for value in values:
+            self._add(entry[0], True, attribute, value)
+
+    def remove(self, name):
+        self._drop(name)
+
+    def _term(self, field, value, prefix):
+        values = self.exact.get(field, {})
+        value = value.lower()
+
+        if not prefix:
+            return set(values.get(value, ()))
+
+        if value == "":
+            return set(name for names in values.values() for name in names)
+
+        keys = self.sorted.get(field, [])
+        matched = set()
+        for i in range(bisect.bisect_left(keys, value), len(keys)):
+            if not keys[i].startswith(value):
+                break
+            matched |= values[keys[i]]
+        return matched
+
+    def evaluate(self, tree):
+        kind = tree[0]
+        if kind == "term":
+            return self._term(*tree[1:])
+        results = [self.evaluate(node) for node in tree[1]]
+        if kind == "and":
+            return set.intersection(*results)
+        return set.union(*results)
+
+    def search(self, restriction, start_index=0, max_results=1000):
+        """Names matching the restriction, sorted and paged; raises UnsupportedRestriction if it cannot be parsed."""
+        tree = check_fields(parse(restriction), self.entity_type)
+        return sorted(self.evaluate(tree))[start_index:start_index + max_results]
+
+
+class LocalSearch:
+    """Lazily built, periodically refreshed local search indexes for a CrowdAPI client.
+
+    Writes made through the client update the indexes in place. Once an
+    index expires, one caller rebuilds it while the others keep searching
+    the old one.
+    """
+
+    def __init__(self, crowd, ttl=300, page_size=1000):
+        self.crowd = crowd
+        self.ttl = ttl
+        self.page_size = page_size
+        self._indexes = {}
+        # writes seen while an index is being rebuilt, replayed on the new one
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._build_locks = {"user": threading.Lock(), "group": threading.Lock()}
+
+    def _build(self, entity_type):
+        with self._lock:
+            self._pending[entity_type] = []
+        try:
+            if entity_type == "user":
+                entities = self.crowd.iter_all_user_entities(page_size=self.page_size)
+            else:
+                entities = self.crowd.iter_all_group_entities(page_size=self.page_size)
+            index = LocalSearchIndex(entity_type, entities)
+        finally:
+            with self._lock:
+                pending = self._pending.pop(entity_type)
+
+        with self._lock:
+            for update in pending:
+                update(index)
+            self._indexes[entity_type] = (time.monotonic() + self.ttl, index)
+
+    def _evaluate(self, entity_type, tree):
+        entry = self._indexes.get(entity_type)
+        if entry is None:
+            # nothing to serve yet, every caller waits for the first build
+            with self._build_locks[entity_type]:
+                if self._indexes.get(entity_type) is None:
+                    self._build(entity_type)
+        elif entry[0] <= time.monotonic() and self._build_locks[entity_type].acquire(blocking=False):
+            try:
+                if self._indexes[entity_type] is entry:
+                    self._build(entity_type)
+            finally:
+                self._build_locks[entity_type].release()
+
+        with self._lock:
+            entry = self._indexes.get(entity_type)
+            if entry is not None:
+                return entry[1].evaluate(tree)
+        # invalidated meanwhile
+        return self._evaluate(entity_type, tree)
+
+    def _update(self, entity_type, update):
+        with self._lock:
+            entry = self._indexes.get(entity_type)
+            if entry is not None:
+                update(entry[1])
+            if entity_type in self._pending:
+                self._pending[entity_type].append(update)
+
+    def put(self, entity_type, entity):
+        self._update(entity_type, lambda index: index.put(entity))
+
+    def set_attribute(self, entity_type, name, attribute, values):
+        self._update(entity_type, lambda index: index.set_attribute(name, attribute, values))
+
+    def remove(self, entity_type, name):
+        self._update(entity_type, lambda index: index.remove(name))
+
+    def invalidate(self, entity_type=None):
+        with self._lock:
+            if entity_type is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(entity_type, None)
+
+    def search(self, entity_type, restriction, start_index=0, max_results=1000):
+        # parse first, so unsupported restrictions never trigger an index build
+        tree = check_fields(parse(restriction), entity_type)
+        return sorted(self._evaluate(entity_type, tree))[start_index:start_index + max_results]
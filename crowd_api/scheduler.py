@@ -0,0 +1,161 @@
+#
+# scheduler.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from .exceptions import CircuitOpenError
+
+
+class TokenBucket:
+    """Client-side rate limiter allowing `rate` requests per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Stop sending requests after `threshold` consecutive failures, probing again after `reset_timeout` seconds."""
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                raise CircuitOpenError(remaining)
+
+            # half-open: let this request through as a probe, hold the others back
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+def retry_after(response):
+    """Return the delay requested by a Retry-After header, in seconds, or None."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """Send requests with retries, exponential backoff with jitter, rate limiting and a circuit breaker.
+
+    429/502/503/504 responses and connection errors are retried up to
+    `max_retries` times. Requests that are not idempotent (POST) are only
+    retried when the server explicitly refused them (429/503), never after a
+    connection error, since Crowd may already have applied them.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+    REFUSED_STATUSES = (429, 503)
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30, rate_limit=None, rate_burst=None,
+                 breaker_threshold=None, breaker_timeout=30):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        self.bucket = None
+        if rate_limit is not None:
+            self.bucket = TokenBucket(rate_limit, rate_burst)
+
+        self.breaker = None
+        if breaker_threshold is not None:
+            self.breaker = CircuitBreaker(breaker_threshold, breaker_timeout)
+
+    def backoff(self, attempt):
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
+
+    def execute(self, send, idempotent=True, event=None):
+        """Send a request through the scheduler; `event`, if given, gets its retry count updated."""
+        attempt = 0
+
+        while True:
+            if event is not None:
+                event.retries = attempt
+
+            if self.breaker is not None:
+                self.breaker.allow()
+            if self.bucket is not None:
+                self.bucket.acquire()
+
+            try:
+                resp = send()
+            except (requests.ConnectionError, requests.Timeout):
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if resp.status_code not in self.RETRY_STATUSES:
+                    if self.breaker is not None:
+                        self.breaker.record_success()
+                    return resp
+
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if attempt >= self.max_retries or (not idempotent and resp.status_code not in self.REFUSED_STATUSES):
+                    return resp
+
+                delay = retry_after(resp)
+                if delay is None:
+                    delay = self.backoff(attempt)
+
+            time.sleep(min(delay, self.max_backoff))
+            attempt += 1
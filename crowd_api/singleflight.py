@@ -0,0 +1,79 @@
+#
+# singleflight.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import asyncio
+import threading
+from urllib.parse import parse_qsl, urlencode
+
+
+def normalize_query(query):
+    """Canonical form of an API query, so equivalent GETs share the same key regardless of parameter order."""
+    path, _, params = query.partition('?')
+    if not params:
+        return path
+    return path + '?' + urlencode(sorted(parse_qsl(params, keep_blank_values=True)))
+
+
+class _Call:
+    __slots__ = ("done", "finished", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = False
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapse concurrent identical calls into one: the first caller runs it, the others wait for its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            if not call.finished:
+                # the leader was interrupted, e.g. by KeyboardInterrupt, before it got an answer
+                raise RuntimeError("Coalesced call for {} was interrupted".format(key))
+            return call.result
+
+        try:
+            call.result = fn()
+            call.finished = True
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """asyncio flavour of SingleFlight; callers of an in-flight key await the same task."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        # shield the shared task so one cancelled waiter does not cancel it for everyone
+        return await asyncio.shield(task)
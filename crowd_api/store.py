@@ -0,0 +1,158 @@
+#
+# store.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+import hashlib
+import json
+import pathlib
+import sqlite3
+import threading
+
+# names are case-insensitive in Crowd, hence NOCASE throughout
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (name TEXT PRIMARY KEY COLLATE NOCASE, digest TEXT NOT NULL, doc TEXT NOT NULL,
+                                  email TEXT COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY COLLATE NOCASE, digest TEXT NOT NULL, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS attributes (entity TEXT NOT NULL, name TEXT NOT NULL COLLATE NOCASE,
+                                       attribute TEXT NOT NULL, value TEXT);
+CREATE INDEX IF NOT EXISTS attributes_value ON attributes (entity, attribute, value);
+CREATE INDEX IF NOT EXISTS attributes_name ON attributes (entity, name);
+CREATE TABLE IF NOT EXISTS memberships (groupname TEXT NOT NULL COLLATE NOCASE, username TEXT NOT NULL COLLATE NOCASE,
+                                        PRIMARY KEY (groupname, username));
+CREATE INDEX IF NOT EXISTS memberships_username ON memberships (username);
+CREATE TABLE IF NOT EXISTS group_children (parent TEXT NOT NULL COLLATE NOCASE, child TEXT NOT NULL COLLATE NOCASE,
+                                           PRIMARY KEY (parent, child));
+CREATE INDEX IF NOT EXISTS group_children_child ON group_children (child);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def digest(doc):
+    """Stable fingerprint of an entity document, used to detect changes."""
+    return hashlib.sha1(json.dumps(doc, sort_keys=True).encode()).hexdigest()
+
+
+class SnapshotStore:
+    """SQLite-backed local copy of the directory: users, groups, their attributes, direct
+    user memberships and group nesting.
+
+    Use the store as a context manager to group writes into one transaction.
+    With `readonly`, an existing snapshot is opened without creating or
+    changing anything.
+    """
+
+    def __init__(self, path=":memory:", readonly=False):
+        self.path = path
+        self.lock = threading.RLock()
+        if readonly:
+            self.conn = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=ro", uri=True,
+                                        check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.lock:
+                self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.lock.release()
+
+    def _table(self, entity):
+        if entity not in ("user", "group"):
+            raise ValueError("Unknown entity type " + entity)
+        return entity + "s"
+
+    def digests(self, entity):
+        """Map of every stored entity name to its digest."""
+        with self.lock:
+            return dict(self.conn.execute("SELECT name, digest FROM " + self._table(entity)))
+
+    def digest(self, entity, name):
+        with self.lock:
+            row = self.conn.execute("SELECT digest FROM {} WHERE name = ?".format(self._table(entity)),
+                                    (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get(self, entity, name):
+        with self.lock:
+            row = self.conn.execute("SELECT doc FROM {} WHERE name = ?".format(self._table(entity)), (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, entity, name, doc):
+        with self.lock:
+            if entity == "user":
+                self.conn.execute("INSERT OR REPLACE INTO users (name, digest, doc, email) VALUES (?, ?, ?, ?)",
+                                  (name, digest(doc), json.dumps(doc), doc.get('email')))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO groups (name, digest, doc) VALUES (?, ?, ?)",
+                                  (name, digest(doc), json.dumps(doc)))
+
+            attributes = doc.get('attributes')
+            if isinstance(attributes, dict):
+                attributes = attributes.get('attributes')
+            if attributes is not None:
+                self.conn.execute("DELETE FROM attributes WHERE entity = ? AND name = ?", (entity, name))
+                self.conn.executemany("INSERT INTO attributes (entity, name, attribute, value) VALUES (?, ?, ?, ?)",
+                                      [(entity, name, a['name'], value)
+                                       for a in attributes for value in a.get('values', [])])
+
+    def delete(self, entity, name):
+        with self.lock:
+            self.conn.execute("DELETE FROM {} WHERE name = ?".format(self._table(entity)), (name,))
+            self.conn.execute("DELETE FROM attributes WHERE entity = ? AND name = ?", (entity, name))
+            if entity == "user":
+                self.conn.execute("DELETE FROM memberships WHERE username = ?", (name,))
+            else:
+                self.conn.execute("DELETE FROM memberships WHERE groupname = ?", (name,))
+                self.conn.execute("DELETE FROM group_children WHERE parent = ? OR child = ?", (name, name))
+
+    def memberships(self):
+        """Set of (groupname, username) direct memberships."""
+        with self.lock:
+            return set(self.conn.execute("SELECT groupname, username FROM memberships"))
+
+    def add_membership(self, groupname, username):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO memberships (groupname, username) VALUES (?, ?)",
+                              (groupname, username))
+
+    def remove_membership(self, groupname, username):
+        with self.lock:
+            self.conn.execute("DELETE FROM memberships WHERE groupname = ? AND username = ?", (groupname, username))
+
+    def set_children(self, parent, children):
+        with self.lock:
+            self.conn.execute("DELETE FROM group_children WHERE parent = ?", (parent,))
+            self.conn.executemany("INSERT OR IGNORE INTO group_children (parent, child) VALUES (?, ?)",
+                                  [(parent, child) for child in children])
+
+    def add_child(self, parent, child):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO group_children (parent, child) VALUES (?, ?)", (parent, child))
+
+    def remove_child(self, parent, child):
+        with self.lock:
+            self.conn.execute("DELETE FROM group_children WHERE parent = ? AND child = ?", (parent, child))
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
@@ -0,0 +1,196 @@
+#
+# sync.py
+#
+# Author: Matteo Cerutti <matteo.cerutti@hotmail.co.uk>
+#
+
+from .executor import run_concurrently
+from .reconcile import MembershipReconciler
+from .store import digest
+
+EVENT_TOKEN = "event_token"
+
+
+class SyncEvent:
+    """A single change found by DirectorySync.
+
+    `entity` is "user", "group" or "membership" and `action` is "added",
+    "removed" or "changed". Membership events carry the group in `group` and
+    the user in `name`.
+    """
+
+    __slots__ = ("entity", "action", "name", "group")
+
+    def __init__(self, entity, action, name, group=None):
+        self.entity = entity
+        self.action = action
+        self.name = name
+        self.group = group
+
+    def __repr__(self):
+        if self.group is not None:
+            return "SyncEvent({} {} {} -> {})".format(self.entity, self.action, self.name, self.group)
+        return "SyncEvent({} {} {})".format(self.entity, self.action, self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, SyncEvent) and \
+            (self.entity, self.action, self.name, self.group) == (other.entity, other.action, other.name, other.group)
+
+    __hash__ = None
+
+
+class DirectorySync:
+    """Keep a SnapshotStore in step with Crowd and report what changed.
+
+    When the server exposes the event feed, each sync only replays the
+    changes since the stored event token. Otherwise, or when the token has
+    expired, the full directory is listed (users and groups as full
+    documents, memberships and child groups with paged listings per group)
+    and diffed against the snapshot by digest.
+    """
+
+    def __init__(self, crowd, store, page_size=1000, concurrency=8, use_events=True):
+        self.crowd = crowd
+        self.store = store
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.use_events = use_events
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(event) for every change found by sync()."""
+        self.listeners.append(listener)
+
+    def sync(self):
+        events = None
+
+        token = self.store.get_meta(EVENT_TOKEN) if self.use_events else None
+        if token is not None:
+            events = self._replay(token)
+
+        if events is None:
+            events = self._full_diff()
+
+        for event in events:
+            for listener in self.listeners:
+                listener(event)
+
+        return events
+
+    def _replay(self, token):
+        res = self.crowd.get_events(token=token)
+        if not res['status']:
+            return None
+
+        events = []
+        with self.store:
+            for change in res['events']:
+                events += self._apply(change)
+            self.store.set_meta(EVENT_TOKEN, res['token'])
+
+        return events
+
+    def _apply(self, change):
+        kind = change.get('type')
+        operation = change.get('operation')
+        events = []
+
+        if kind in ("USER", "GROUP"):
+            entity = kind.lower()
+            doc = change[entity]
+            known = self.store.digest(entity, doc['name'])
+
+            if operation == "DELETED":
+                if known is not None:
+                    self.store.delete(entity, doc['name'])
+                    events.append(SyncEvent(entity, "removed", doc['name']))
+            elif known is None:
+                self.store.put(entity, doc['name'], doc)
+                events.append(SyncEvent(entity, "added", doc['name']))
+            else:
+                # events may carry a partial document, keep the stored fields they omit
+                doc = dict(self.store.get(entity, doc['name']), **doc)
+                if known != digest(doc):
+                    self.store.put(entity, doc['name'], doc)
+                    events.append(SyncEvent(entity, "changed", doc['name']))
+
+        elif kind == "USER_MEMBERSHIP":
+            username = change['childUser']['name']
+            for group in change.get('parentGroups', []):
+                if operation == "DELETED":
+                    self.store.remove_membership(group['name'], username)
+                    events.append(SyncEvent("membership", "removed", username, group['name']))
+                else:
+                    self.store.add_membership(group['name'], username)
+                    events.append(SyncEvent("membership", "added", username, group['name']))
+
+        elif kind == "GROUP_MEMBERSHIP":
+            # group nesting is kept in the snapshot but not reported as events
+            child = change['childGroup']['name']
+            for group in change.get('parentGroups', []):
+                if operation == "DELETED":
+                    self.store.remove_child(group['name'], child)
+                else:
+                    self.store.add_child(group['name'], child)
+
+        return events
+
+    def _diff_entities(self, entity, docs):
+        events = []
+        known = self.store.digests(entity)
+
+        for doc in docs:
+            name = doc['name']
+            old = known.pop(name, None)
+            if old is None:
+                self.store.put(entity, name, doc)
+                events.append(SyncEvent(entity, "added", name))
+            elif old != digest(doc):
+                self.store.put(entity, name, doc)
+                events.append(SyncEvent(entity, "changed", name))
+
+        for name in known:
+            self.store.delete(entity, name)
+            events.append(SyncEvent(entity, "removed", name))
+
+        return events
+
+    def _full_diff(self):
+        # take the token first, so changes made while listing are replayed next time
+        token = None
+        if self.use_events:
+            res = self.crowd.get_event_token()
+            if res['status']:
+                token = res['token']
+
+        users = list(self.crowd.iter_all_user_entities(page_size=self.page_size))
+        groups = list(self.crowd.iter_all_group_entities(page_size=self.page_size))
+
+        reconciler = MembershipReconciler(self.crowd, page_size=self.page_size, concurrency=self.concurrency)
+        current = reconciler.load_current([g['name'] for g in groups])
+        memberships = {(groupname, username) for groupname, members in current.items() for username in members}
+
+        children = dict(run_concurrently(
+            lambda g: list(self.crowd.iter_direct_children_of_group(g, page_size=self.page_size)),
+            current, self.concurrency))
+
+        events = []
+        with self.store:
+            events += self._diff_entities("user", users)
+            events += self._diff_entities("group", groups)
+
+            known = self.store.memberships()
+            for groupname, username in sorted(memberships - known):
+                self.store.add_membership(groupname, username)
+                events.append(SyncEvent("membership", "added", username, groupname))
+            for groupname, username in sorted(known - memberships):
+                self.store.remove_membership(groupname, username)
+                events.append(SyncEvent("membership", "removed", username, groupname))
+
+            for groupname, nested in children.items():
+                self.store.set_children(groupname, nested)
+
+            if token is not None:
+                self.store.set_meta(EVENT_TOKEN, token)
+
+        return events
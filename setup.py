@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 version = '0.1.0'
 
@@ -13,5 +13,17 @@ setup(
   download_url='https://github.com/m4ce/crowd-api-python/tarball/%s' % (version,),
   keywords=['crowd'],
   classifiers=[],
-  install_requires=["requests"]
+  python_requires='>=3.6',
+  install_requires=["requests"],
+  extras_require={
+    "async": ["aiohttp"],
+    "orjson": ["orjson"],
+    "onboard": ["jinja2", "pyyaml"],
+  },
+  entry_points={
+    "console_scripts": [
+      "crowd-onboard = crowd_api.cli:main",
+      "crowd-snapshot = crowd_api.offline:main",
+    ],
+  }
 )